@@ -14,6 +14,7 @@ class Errors(Enum):
     MPV_SCREENSHOT_ERROR = 2
     FFMPEG_AUDIO_ERROR = 3
     MPV_AUDIO_ERROR = 4
+    FFMPEG_EXPORT_ERROR = 5
 
 
 class AnkiExporter:
@@ -68,21 +69,29 @@ class AnkiExporter:
         file_base = 'mpv-' + str(int(round(time.time() * 1000)))
         anki_media_collection_path = self.get_media_path()
 
-        # Get image
         img_name = file_base + '.' + self.image_format
         img_path = os.path.join(anki_media_collection_path, img_name)
         img_path = os.path.normpath(img_path)
-        error = self.make_screenshot(media_file, time_start, time_end, img_path)
-        if error:
-            raise self.ExportError('Generating image failed: ' + str(error))
-
-        # Get audio
         audio_name = file_base + '.' + self.audio_format
         audio_path = os.path.join(anki_media_collection_path, audio_name)
         audio_path = os.path.normpath(audio_path)
-        error = self.make_audio(media_file, audio_track, time_start, time_end, audio_path)
-        if error:
-            raise self.ExportError('Generating audio failed: ' + str(error))
+
+        # Get image and audio with one ffmpeg run, the media is only opened and seeked once
+        error = self.ffmpeg_screenshot_and_audio(media_file, audio_track, time_start, time_end, img_path, audio_path)
+
+        # Fall back to getting them one by one
+        if error is not None:
+            print("EXPORT: Falling back to separate image and audio export")
+
+            # Get image
+            error = self.make_screenshot(media_file, time_start, time_end, img_path)
+            if error:
+                raise self.ExportError('Generating image failed: ' + str(error))
+
+            # Get audio
+            error = self.make_audio(media_file, audio_track, time_start, time_end, audio_path)
+            if error:
+                raise self.ExportError('Generating audio failed: ' + str(error))
 
         # Make sure that the files were created
         if not os.path.exists(img_path) or not os.path.exists(audio_path):
@@ -108,6 +117,46 @@ class AnkiExporter:
         # Browse to it
         self._invoke_anki_connect('guiBrowse', query='nid:' + str(last_notes[0]))
 
+    def ffmpeg_screenshot_and_audio(self, media_file, audio_track, start, end, img_path, audio_path):
+        if not self.ffmpeg_executable:
+            return Errors.FFMPEG_EXPORT_ERROR
+
+        # Input seeking to the start, both outputs read the same demuxed input. The image output skips to the middle
+        # on its own.
+        args = [
+            self.ffmpeg_executable,
+            '-y', '-loglevel', 'error',
+            '-ss', str(start),
+            '-t', str(end - start),
+            '-i', media_file,
+            # Image, the first video stream that is not cover art
+            '-map', '0:V:0',
+            '-ss', str((end - start) / 2),
+            '-frames:v', '1',
+            *self._ffmpeg_scale_args(),
+            img_path,
+            # Audio
+            '-map', '0:' + str(audio_track),
+            '-acodec', 'mp3',
+            audio_path
+        ]
+
+        try:
+            proc = subprocess.Popen(args)
+            r = proc.wait()
+        except FileNotFoundError:
+            return Errors.FFMPEG_EXPORT_ERROR
+
+        # Check that both were saved, a half done export is redone by the fallback
+        if r != 0 or not os.path.exists(img_path) or not os.path.exists(audio_path):
+            for path in [img_path, audio_path]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return Errors.FFMPEG_EXPORT_ERROR
+        return None
+
     def ffmpeg_audio(self, media_file, audio_track, start, end, out_path):
         args = [
             self.ffmpeg_executable,
@@ -166,9 +215,22 @@ class AnkiExporter:
             '-ss', str((start + end) / 2),
             '-i', media_file,
             '-vframes', '1',
+            *self._ffmpeg_scale_args(),
             out_path
         ]
 
+        try:
+            proc = subprocess.Popen(args)
+            proc.wait()
+        except FileNotFoundError:
+            return Errors.FFMPEG_SCREENSHOT_ERROR
+
+        # Check that image was saved
+        if not os.path.exists(out_path):
+            return Errors.FFMPEG_SCREENSHOT_ERROR
+        return None
+
+    def _ffmpeg_scale_args(self):
         # See https://ffmpeg.org/ffmpeg-filters.html#scale-1 for scaling options
 
         # None or values smaller than 1 set the axis to auto
@@ -181,22 +243,12 @@ class AnkiExporter:
 
         # Only apply filter if any axis is set to non-auto
         if w > 0 or h > 0:
-            args[-1:-1] = [
+            return [
                 '-filter:v',
                 'scale=w=\'min(iw,%d)\':h=\'min(ih,%d)\':force_original_aspect_ratio=decrease'
                 % (w, h)
             ]
-
-        try:
-            proc = subprocess.Popen(args)
-            proc.wait()
-        except FileNotFoundError:
-            return Errors.FFMPEG_SCREENSHOT_ERROR
-
-        # Check that image was saved
-        if not os.path.exists(out_path):
-            return Errors.FFMPEG_SCREENSHOT_ERROR
-        return None
+        return []
 
     def mpv_screenshot(self, media_file, start, end, out_path):
         if not self.mpv_executable:
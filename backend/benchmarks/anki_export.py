@@ -0,0 +1,91 @@
+# Compares exporting the image and audio of an Anki card with two ffmpeg runs (as update_last_note did before) and
+# with the single ffmpeg run of AnkiExporter.ffmpeg_screenshot_and_audio.
+#
+# Usage: python backend/benchmarks/anki_export.py [media_file_or_url ...]
+#
+# Requires ffmpeg on the PATH or in the plugin directory. Without arguments, a 10 minute test video is generated.
+# The audio is taken from stream 1, like in the generated video.
+# Pass http(s) URLs to measure media that is streamed.
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ankiexport import AnkiExporter
+from config import Config
+from executables import Executables
+
+# (start, end) in seconds of the exported cards, spread over the media
+CARDS = [(30.0, 33.5), (150.0, 152.0), (301.5, 306.0), (480.0, 484.0)]
+ROUNDS = 3
+
+
+def generate_media(ffmpeg, path):
+    subprocess.run([ffmpeg, '-y', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', 'testsrc2=size=1920x1080:rate=24',
+                    '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+                    '-t', '600', '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '240', '-c:a', 'aac', path],
+                   check=True)
+
+
+def export_separate(exporter, media, start, end, img_path, audio_path):
+    return exporter.ffmpeg_screenshot(media, start, end, img_path) or \
+        exporter.ffmpeg_audio(media, 1, start, end, audio_path)
+
+
+def export_single_pass(exporter, media, start, end, img_path, audio_path):
+    return exporter.ffmpeg_screenshot_and_audio(media, 1, start, end, img_path, audio_path)
+
+
+def run(exporter, media, out_dir):
+    print(media)
+    for name, func in [('two runs', export_separate), ('one run', export_single_pass)]:
+        times = []
+        for _ in range(ROUNDS):
+            for i, (start, end) in enumerate(CARDS):
+                img_path = os.path.join(out_dir, '%d.png' % i)
+                audio_path = os.path.join(out_dir, '%d.wav' % i)
+                for path in [img_path, audio_path]:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+                t = time.perf_counter()
+                error = func(exporter, media, start, end, img_path, audio_path)
+                times.append(time.perf_counter() - t)
+                if error is not None:
+                    print('  %s: failed (%s)' % (name, error))
+                    return
+        times.sort()
+        print('  %s: median %.3fs, min %.3fs, max %.3fs per card' %
+              (name, times[len(times) // 2], times[0], times[-1]))
+
+
+def main():
+    plugin_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+    config = Config()
+    exporter = AnkiExporter(config, Executables(plugin_dir, config))
+    if not exporter.ffmpeg_executable:
+        print('ffmpeg not found')
+        return
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        media_files = sys.argv[1:]
+        if not media_files:
+            media_files = [os.path.join(out_dir, 'test.mp4')]
+            print('Generating', media_files[0])
+            generate_media(exporter.ffmpeg_executable, media_files[0])
+
+        for media in media_files:
+            run(exporter, media, out_dir)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Replays mpv IPC traffic through the previous line framing of MpvIpc_Base.listen and through JsonLineFramer.
+#
+# Usage: python backend/benchmarks/ipc_framing.py [recorded_ipc.jsonl]
+#
+# Without a recording, traffic resembling a burst of time-pos/sub-text property changes is generated. Record real
+# traffic by dumping the bytes received from the IPC socket (e.g. with socat -v) into a file.
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.mpv_ipc import JsonLineFramer
+
+READ_SIZE_OLD = 1024
+READ_SIZE_NEW = 64 * 1024
+
+
+def generate_traffic(events=200000):
+    lines = []
+    for i in range(events):
+        if i % 10 == 0:
+            event = {'event': 'property-change', 'id': 2, 'name': 'sub-text', 'data': '字幕のテキスト %d です' % i}
+        else:
+            event = {'event': 'property-change', 'id': 1, 'name': 'time-pos', 'data': i * 0.016}
+        lines.append(json.dumps(event, ensure_ascii=False))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def chunks(data, size):
+    # Reads rarely end on a line boundary, use an odd size so they don't
+    size -= 7
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def listen_old(data, parse):
+    # Framing as done by MpvIpc_Base.listen before JsonLineFramer
+    count = 0
+    buffer = b''
+    for new_data in chunks(data, READ_SIZE_OLD):
+        buffer += new_data
+        if buffer[-1] != 10:
+            continue
+        for line in buffer.decode('utf-8', errors='ignore').split('\n'):
+            if line != '':
+                if parse:
+                    json.loads(line)
+                count += 1
+        buffer = b''
+    return count
+
+
+def listen_new(data, parse):
+    count = 0
+    framer = JsonLineFramer()
+    for new_data in chunks(data, READ_SIZE_NEW):
+        for line in framer.feed(new_data):
+            if parse:
+                json.loads(line)
+            count += 1
+    return count
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            data = f.read()
+    else:
+        data = generate_traffic()
+
+    print('Traffic: %d bytes, %d lines' % (len(data), data.count(b'\n')))
+
+    for parse in [False, True]:
+        for name, func in [('old', listen_old), ('new', listen_new)]:
+            start = time.perf_counter()
+            count = func(data, parse)
+            elapsed = time.perf_counter() - start
+            print('%s%s: %d events in %.3fs (%.0f events/s)' %
+                  (name, ' + json' if parse else '', count, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Compares parsing SRT/WebVTT with pysubs2 (as load_subs_from_info did before) and with subtitle_parser.
+#
+# Usage: python backend/benchmarks/subtitle_parsing.py [subtitle_file ...]
+#
+# Without files, SRT and WebVTT files with 10k, 50k and 100k cues are generated.
+
+import os
+import sys
+import time
+
+import pysubs2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import subtitle_parser
+
+
+def timestamp(ms, separator):
+    return '%02d:%02d:%02d%s%03d' % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, separator, ms % 1000)
+
+
+def generate_srt(cues):
+    blocks = []
+    for i in range(cues):
+        blocks.append('%d\n%s --> %s\n<i>字幕のテキスト</i> %d\nsecond line\n' %
+                      (i + 1, timestamp(i * 2000, ','), timestamp(i * 2000 + 1500, ','), i))
+    return '\n'.join(blocks)
+
+
+def generate_vtt(cues):
+    blocks = ['WEBVTT\n']
+    for i in range(cues):
+        blocks.append('%s --> %s align:start position:0%%\n<c.white>字幕のテキスト</c> %d &amp; more\n' %
+                      (timestamp(i * 2000, '.'), timestamp(i * 2000 + 1500, '.'), i))
+    return '\n'.join(blocks)
+
+
+def parse_pysubs2(text):
+    subs = pysubs2.SSAFile.from_string(text)
+    subs.sort()
+    return [(s.plaintext.strip(), s.start, s.end) for s in subs]
+
+
+def parse_native(text):
+    return subtitle_parser.parse(text)
+
+
+def run(name, text):
+    print('%s: %d bytes' % (name, len(text.encode('utf-8'))))
+    for parser_name, func in [('pysubs2', parse_pysubs2), ('native', parse_native)]:
+        start = time.perf_counter()
+        cues = func(text)
+        elapsed = time.perf_counter() - start
+        print('  %s: %d cues in %.3fs (%.0f cues/s)' % (parser_name, len(cues), elapsed, len(cues) / elapsed))
+
+
+def main():
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, encoding='utf-8', errors='replace') as f:
+                run(path, f.read())
+        return
+
+    for cues in [10000, 50000, 100000]:
+        run('srt, %d cues' % cues, generate_srt(cues))
+        run('vtt, %d cues' % cues, generate_vtt(cues))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,12 @@ class Config:
         self.port_max = 65535
         self.skip_empty_subs = True
         self.subtitle_export_timeout = 0
+        self.subtitle_cache_size = 100
+        self.extraction_cache_size = 200
+        self.download_cache_size = 50
+        self.resync_cache_size = 100
+        self.resync_max_jobs = 1
+        self.prefetch_count = 2
         self.mpv_path = None
         self.anki_image_width = -1
         self.anki_image_height = -1
@@ -40,6 +46,18 @@ class Config:
                                                  fallback=self.skip_empty_subs)
         self.subtitle_export_timeout = parser.getint(configparser.UNNAMED_SECTION, 'subtitle_export_timeout',
                                                      fallback=self.subtitle_export_timeout)
+        self.subtitle_cache_size = parser.getint(configparser.UNNAMED_SECTION, 'subtitle_cache_size',
+                                                 fallback=self.subtitle_cache_size)
+        self.extraction_cache_size = parser.getint(configparser.UNNAMED_SECTION, 'extraction_cache_size',
+                                                   fallback=self.extraction_cache_size)
+        self.download_cache_size = parser.getint(configparser.UNNAMED_SECTION, 'download_cache_size',
+                                                 fallback=self.download_cache_size)
+        self.resync_cache_size = parser.getint(configparser.UNNAMED_SECTION, 'resync_cache_size',
+                                               fallback=self.resync_cache_size)
+        self.resync_max_jobs = parser.getint(configparser.UNNAMED_SECTION, 'resync_max_jobs',
+                                             fallback=self.resync_max_jobs)
+        self.prefetch_count = parser.getint(configparser.UNNAMED_SECTION, 'prefetch_count',
+                                            fallback=self.prefetch_count)
         self.mpv_path = parser.get(configparser.UNNAMED_SECTION, 'mpv_path', fallback=self.mpv_path)
         self.anki_image_width = parser.getint(configparser.UNNAMED_SECTION, 'anki_image_width',
                                               fallback=self.anki_image_width)
@@ -1,8 +1,10 @@
+import asyncio
 import collections
+import concurrent.futures
+import functools
 import json
 import os
 import platform
-import queue
 import shutil
 import sys
 import threading
@@ -20,9 +22,17 @@ from config import Config
 from executables import Executables
 from mpv_last_state import MpvLastState
 from queue_handler import QueueHandler
-from subtitle_manager import load_subs_from_info, SubtitleLoadError
-from utils.mpv_ipc import MpvIpc
-from utils.server import HttpServer, HttpResponse
+from resync_manager import ResyncManager, ResyncCancelledError
+from subtitle_cache import SubtitleCache
+from subtitle_extractor import SubtitleExtractor
+from subtitle_manager import load_subs_from_info, kill_streaming_processes, SubtitleLoadError
+from subtitle_prefetcher import SubtitlePrefetcher
+from subtitle_search import SubtitleIndex, CachedTracksIndex
+from subtitle_track import SubtitleTrack
+from utils.disk_cache import DiskCache
+from utils.downloader import Downloader
+from utils.mpv_ipc import MpvIpcAsync
+from utils.server import HttpServer, HttpResponse, HttpContent, websocket_frame
 
 # Plugin dir
 if getattr(sys, 'frozen', False):
@@ -33,11 +43,14 @@ else:
 # Temporary directory to store stuff, gets cleared on startup and shutdown
 tmp_dir = os.path.join(plugin_dir, 'tmp')
 
+# Directory of caches that are kept between sessions
+cache_dir = os.path.join(plugin_dir, 'cache')
+
 # Log file handle, None if not used (in dev mode we use stdout/stderr)
 log_file: typing.TextIO | None = None
 
 # MPC IPC object
-mpv: MpvIpc
+mpv: MpvIpcAsync
 
 # Config-like objects
 config: Config
@@ -46,6 +59,30 @@ executables: Executables
 # Anki exporter object
 anki_exporter: AnkiExporter
 
+# Cache of parsed subtitle files, None if disabled
+subtitle_cache: SubtitleCache | None = None
+
+# Search index over all tracks in the subtitle cache, None if the cache is disabled
+cached_tracks_index: CachedTracksIndex | None = None
+
+# Cache of exported internal subtitle tracks, None if disabled
+extraction_cache: DiskCache | None = None
+
+# Exports the internal subtitle tracks of the loaded file in the background
+extractor: SubtitleExtractor | None = None
+
+# Prepares the subtitles of the next playlist entries, None if disabled
+prefetcher: SubtitlePrefetcher | None = None
+
+# Downloads web subtitles, caches them if enabled
+downloader: Downloader | None = None
+
+# Runs subtitle syncs, created on the loop
+resync_manager: ResyncManager | None = None
+
+# Cache of speech detected in resync references, None if disabled
+resync_cache: DiskCache | None = None
+
 # Server
 server: HttpServer | None = None
 
@@ -55,20 +92,71 @@ mpv_last_state: MpvLastState = MpvLastState()
 # Queue handler for all the data streams
 queue_handler = QueueHandler()
 
+# Serialized subtitles as (state version, content), see subs_content()
+subs_contents: dict[str, tuple[int, HttpContent]] = {}
+
+# Search indexes of the subtitles as (state version, subtitles, index), see search_index()
+search_indexes: dict[str, tuple[int, SubtitleTrack, SubtitleIndex]] = {}
+
+# Maximum number of results per searched track
+SEARCH_LIMIT = 200
+
+# The backend runs on one asyncio loop, blocking work (ffmpeg, parsing, downloads, ...) goes to this bounded pool
+worker_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='Worker')
+
+# Tasks started with spawn(), referenced here so they don't get garbage collected while running
+background_tasks: set[asyncio.Task] = set()
+
+# Only one open request is handled at a time
+open_lock = asyncio.Lock()
+
 # Last time a subtitle request was made, used to determine if we should force open a new tab
 last_subs_request = 0
 
 
 ### Handlers for GET requests
 
+def subs_snapshot(name: str) -> tuple[int, SubtitleTrack]:
+    # Version and subs read together, the state is changed on the loop while workers read it
+    version, subs, secondary_subs = mpv_last_state.snapshot()
+    return version, subs if name == 'subs' else secondary_subs
+
+
+def subs_content(name: str) -> HttpContent:
+    # Serialize the subtitle list once per state version, requests only copy the cached bytes
+    version, subs = subs_snapshot(name)
+    cached = subs_contents.get(name)
+    if cached is None or cached[0] != version:
+        subs_json = subs.to_json(version)
+        # brotli at max quality is too slow for data that changes with every file
+        cached = (version, HttpContent(subs_json, 'application/json; charset=utf-8', ['gzip']))
+        subs_contents[name] = cached
+    return cached[1]
+
+
+def search_index(name: str) -> tuple[SubtitleTrack, SubtitleIndex]:
+    # Index the subtitles once per state version, the index belongs to the returned subtitles
+    version, subs = subs_snapshot(name)
+    cached = search_indexes.get(name)
+    if cached is None or cached[0] != version:
+        cached = (version, subs, SubtitleIndex(subs.texts()))
+        search_indexes[name] = cached
+    return cached[1], cached[2]
+
+
+def prepare_subs():
+    # Serialize and index new subtitles before the browser asks for them
+    for name in ['subs', 'secondary_subs']:
+        subs_content(name)
+        search_index(name)
+
+
 # Handler to provide main subtitles
 def get_handler_subs(socket):
     global last_subs_request
     last_subs_request = time.time()
 
-    # Turn them into json
-    subs_json = json.dumps(mpv_last_state.subs, default=vars)
-    r = HttpResponse(content=subs_json.encode(), content_type='text/html')
+    r = subs_content('subs').response(socket.request)
     r.send(socket)
 
 
@@ -77,44 +165,58 @@ def get_handler_secondary_subs(socket):
     global last_subs_request
     last_subs_request = time.time()
 
-    # Turn them into json
-    secondary_subs_json = json.dumps(mpv_last_state.secondary_subs, default=vars)
-    r = HttpResponse(content=secondary_subs_json.encode(), content_type='text/html')
+    r = subs_content('secondary_subs').response(socket.request)
     r.send(socket)
 
 
-# Event source registration handler for data streams
-def get_handler_data(socket):
-    r = HttpResponse(content_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+# Handler to search the subtitles for ?q=..., with &cache=1 the tracks in the subtitle cache are searched too
+def get_handler_search(socket):
+    query = socket.request.query.get('q', '')
+
+    results = []
+    for name, track in [('subs', 'primary'), ('secondary_subs', 'secondary')]:
+        subs, index = search_index(name)
+        for i in index.search(query, SEARCH_LIMIT):
+            results.append({'track': track, 'id': i, 'start': subs.starts[i], 'end': subs.ends[i],
+                            'text': subs.text(i)})
+
+    if socket.request.query.get('cache') == '1' and cached_tracks_index is not None:
+        for source, start, end, text in cached_tracks_index.search(query, SEARCH_LIMIT):
+            results.append({'track': 'cache', 'source': source, 'start': start, 'end': end, 'text': text})
+
+    r = HttpResponse(content=json.dumps({'results': results}, ensure_ascii=False).encode(),
+                     content_type='application/json; charset=utf-8')
     r.send(socket)
 
-    q = queue.Queue()
 
-    # Register the queue to the queue handler
-    queue_handler.add_queue(q)
+# Event source registration handler for data streams
+def get_handler_data(socket):
+    r = HttpResponse(content_type='text/event-stream', headers={'Cache-Control': 'no-cache'}, stream=True)
+    r.send(socket)
 
-    keep_listening = True
-    while keep_listening:
-        data = q.get()
+    # Reconnect quickly, the browser sends the last event id so no events are lost in between
+    socket.send(b'retry: 1000\r\n\r\n')
 
-        if len(data) < 1:
-            keep_listening = False
-        else:
-            cmd = data[0]
+    client = queue_handler.add_client(socket.request.header('Last-Event-ID'))
+    # An event with only an id dispatches nothing but sets the id the browser resumes from
+    socket.send(('id: ' + queue_handler.initial_event_id(client) + '\r\n\r\n').encode())
 
-            if cmd in ['s', 'r']:
-                send_msg = 'data: ' + data + '\r\n\r\n'
-                try:
-                    socket.sendall(send_msg.encode())
-                except:
-                    keep_listening = False
-            else:
-                keep_listening = False
+    # Called by the server whenever the connection can take more data
+    def produce_data():
+        send_msgs = []
+        # Same events as on the control socket
+        for event_id, data in queue_handler.read(client):
+            if event_id is not None:
+                send_msgs.append('id: ' + event_id + '\r\n')
+            send_msgs.append('data: ' + data + '\r\n\r\n')
+            if data == 'q':
+                socket.close()
+                break
 
-        q.task_done()
+        return ''.join(send_msgs).encode()
 
-    # Remove the queue from the queue handler
-    queue_handler.remove_queue(q)
+    # The client gets removed again once the connection closes
+    socket.hold(produce_data, on_close=lambda: queue_handler.remove_client(client))
 
 
 ### Handlers for POST requests
@@ -123,13 +225,30 @@ def get_handler_data(socket):
 def post_handler_anki(socket, data):
     if mpv_last_state.audio_track < 0:
         mpv.show_text('Please select an audio track before opening Migaku MPV if you want to export Anki cards.')
+        r = HttpResponse()
+        r.send(socket)
         return
 
     # Get the provided card
     card = json.loads(data.decode())
 
-    # Fetch the card data to apply to the last note
-    translation_text = card['translation_text']
+    # Fetch the card data to apply to the last note. The translation is resolved from the ids of the selected subs,
+    # older pages send the text itself.
+    translation_text = card.get('translation_text', '')
+    ids = card.get('ids')
+    if ids:
+        version, subs, secondary_subs = mpv_last_state.snapshot()
+        # Ids of subs the page loaded before a reload or update point to other lines now
+        if card.get('version') != version:
+            mpv.show_text('Subtitles changed since they were selected, please try again.')
+            r = HttpResponse(409)
+            r.send(socket)
+            return
+        if not all(isinstance(i, int) and 0 <= i < len(subs) for i in ids):
+            r = HttpResponse(400)
+            r.send(socket)
+            return
+        translation_text = subs.translation(ids, secondary_subs)
     start = card['start'] / 1000.0
     end = card['end'] / 1000.0
 
@@ -153,12 +272,89 @@ def post_handler_mpv_control(socket, data):
     r.send(socket)
 
 
+# Cancels running and queued subtitle syncs
+def post_handler_resync_cancel(socket, data):
+    cancel_resync()
+
+    r = HttpResponse()
+    r.send(socket)
+
+
+### Handlers for the control WebSocket, carries events to the browser and commands to mpv
+
+# Opens a control socket, events are sent as {"id": ..., "data": ...} like on the /data stream
+def websocket_open_handler_control(socket):
+    client = queue_handler.add_client(socket.request.query.get('last_event_id'))
+    # Gives the client a position to resume from, events without data only carry the id
+    socket.send_message(json.dumps({'id': queue_handler.initial_event_id(client), 'data': None}))
+
+    def produce_data():
+        send_frames = []
+        for event_id, data in queue_handler.read(client):
+            send_frames.append(websocket_frame(json.dumps({'id': event_id, 'data': data}).encode()))
+            if data == 'q':
+                send_frames.append(websocket_frame(b'', 0x8))
+                socket.close()
+                break
+
+        return b''.join(send_frames)
+
+    socket.hold(produce_data, on_close=lambda: queue_handler.remove_client(client))
+
+
+# Forwards {"id": ..., "command": [...]} to mpv, the reply is sent back as {"reply": id, "error": ..., "data": ...}
+def websocket_message_handler_control(socket, message):
+    request = json.loads(message)
+    command = {'command': request['command']}
+
+    reply_id = request.get('id')
+    if reply_id is None:
+        mpv.send_json(command)
+        return
+
+    def send_reply(future):
+        # Cancelled on shutdown, failed when the IPC connection closed
+        if future.cancelled() or future.exception() is not None:
+            socket.send_message(json.dumps({'reply': reply_id, 'error': 'no reply from mpv', 'data': None}))
+            return
+        reply = future.result()
+        socket.send_message(json.dumps({'reply': reply_id, 'error': reply.get('error'), 'data': reply.get('data')}))
+
+    mpv.request_json(command).add_done_callback(send_reply)
+
+
 ### Managing data streams
 
 def send_subtitle_time(arg):
-    # Send the current subtitle time to the browser + delay
-    time_millis = (int(round(float(arg) * 1000)) + mpv_last_state.subs_delay) // 10 * 10
-    queue_handler.send_data('s' + str(time_millis))
+    # Send the current subtitle time to the browser, the subs there are not shifted by the delay either
+    time_millis = int(round(float(arg) * 1000)) // 10 * 10
+    # Only the latest position matters, clients that are behind skip the ones in between
+    queue_handler.send_latest('s' + str(time_millis))
+
+
+def send_subs_delay(arg):
+    # The browser shifts the subs by the delay itself, changing it doesn't touch them
+    mpv_last_state.subs_delay = int(round(float(arg) * 1000))
+    queue_handler.send_latest('d' + str(mpv_last_state.subs_delay))
+
+
+def spawn(coro):
+    # Runs a coroutine on the loop, unhandled exceptions end the backend just like they do in threads
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+
+    def task_done(t):
+        background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            exc = t.exception()
+            exception_hook(type(exc), exc, exc.__traceback__)
+
+    task.add_done_callback(task_done)
+    return task
+
+
+async def run_blocking(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(worker_executor, functools.partial(func, *args, **kwargs))
 
 
 def open_webbrowser_new_tab():
@@ -172,19 +368,19 @@ def open_webbrowser_new_tab():
         webbrowser.open(url, new=0, autoraise=True)
 
 
-def tab_reload_timeout():
-    time.sleep(config.reuse_last_tab_timeout)
+async def tab_reload_timeout():
+    await asyncio.sleep(config.reuse_last_tab_timeout)
 
     if last_subs_request < (time.time() - (config.reuse_last_tab_timeout + 0.25)):
         print('BRS: Tab timed out.')
-        open_webbrowser_new_tab()
+        await run_blocking(open_webbrowser_new_tab)
 
 
 ### Called when user presses the migaku key in mpv, transmits info about playing environment
 
 # TODO: Split this
-def load_and_open_migaku(mpv_pid, mpv_media_path, mpv_audio_track, mpv_sub_info, mpv_secondary_sub_info,
-                         mpv_subs_delay, mpv_resx, mpv_resy):
+async def load_and_open_migaku(mpv_pid, mpv_media_path, mpv_audio_track, mpv_sub_info, mpv_secondary_sub_info,
+                               mpv_subs_delay, mpv_resx, mpv_resy):
     global mpv_last_state
 
     if server is None:
@@ -208,77 +404,187 @@ def load_and_open_migaku(mpv_pid, mpv_media_path, mpv_audio_track, mpv_sub_info,
     # Store received state
     mpv_last_state = MpvLastState(
         mpv_media_path, int(mpv_audio_track), int(round(float(mpv_subs_delay) * 1000)),
-        int(mpv_resx), int(mpv_resy), [], [])
+        int(mpv_resx), int(mpv_resy))
+
+    state = mpv_last_state
+    queue_handler.send_latest('d' + str(state.subs_delay))
+    loop = asyncio.get_running_loop()
+    frontend_opened = False
+    subs_loaded = False
+
+    # Partially exported subs are shown right away, the browser is told to refetch as more come in
+    def publish_partial_subs(subs):
+        nonlocal frontend_opened
+        if state is not mpv_last_state or subs_loaded:
+            return
+        state.set_subs(subs)
+        spawn(notify_partial_subs(not frontend_opened))
+        frontend_opened = True
+
+    async def notify_partial_subs(open_frontend):
+        # Serialize on the worker pool before the browser is told to fetch
+        await run_blocking(subs_content, 'subs')
+        if open_frontend:
+            await open_or_refresh_frontend()
+        else:
+            queue_handler.send_latest('u', replay=False)
+
+    def on_partial_subs(subs):
+        loop.call_soon_threadsafe(publish_partial_subs, subs)
+
+    # Streamed subs start around the playback position
+    position_hint = None
+    try:
+        time_pos = await mpv.get_property('time-pos')
+        if time_pos is not None:
+            position_hint = int(float(time_pos) * 1000) - state.subs_delay
+    except Exception:
+        pass
+
+    # Secondary subs load in parallel, the browser doesn't wait for them
+    secondary_task = None
+    if mpv_secondary_sub_info:
+        secondary_task = asyncio.ensure_future(run_blocking(
+            load_subs_from_info, mpv, tmp_dir, executables, config, mpv_media_path,
+            mpv_secondary_sub_info, subtitle_cache, extraction_cache, extractor,
+            downloader=downloader))
 
     # Load main subs
     try:
-        mpv_last_state.subs = load_subs_from_info(
-            mpv, tmp_dir, executables, config, mpv_media_path, mpv_sub_info,
-            mpv_last_state.subs_delay)
+        subs = await run_blocking(
+            load_subs_from_info, mpv, tmp_dir, executables, config, mpv_media_path, mpv_sub_info, subtitle_cache,
+            extraction_cache, extractor, on_partial_subs, position_hint, downloader)
     except SubtitleLoadError as e:
         mpv.show_text(str(e))
+        if secondary_task is not None:
+            # Can't stop the worker, only make sure its result is dropped quietly
+            secondary_task.add_done_callback(lambda t: t.cancelled() or t.exception())
         return
+    state.set_subs(subs)
+    subs_loaded = True
 
-    # Load secondary subs
-    if mpv_secondary_sub_info:
-        try:
-            mpv_last_state.secondary_subs = load_subs_from_info(
-                mpv, tmp_dir, executables, config, mpv_media_path,
-                mpv_secondary_sub_info, mpv_last_state.subs_delay)
-        except SubtitleLoadError:
-            pass
+    # Take the secondary subs along if they are ready already
+    if secondary_task is not None and secondary_task.done():
+        await set_secondary_subs(state, secondary_task)
+        secondary_task = None
 
-    # Open or refresh frontend
-    open_or_refresh_frontend()
+    # Serialize and index the new subtitles before the browser asks for them
+    await run_blocking(prepare_subs)
+
+    # Open or refresh frontend, if it shows partial subs already it only needs to refetch
+    if frontend_opened:
+        queue_handler.send_latest('u', replay=False)
+    else:
+        await open_or_refresh_frontend()
 
+    # Tell the browser to refetch once the secondary subs arrive
+    if secondary_task is not None:
+        await set_secondary_subs(state, secondary_task)
+        if state is mpv_last_state:
+            await run_blocking(prepare_subs)
+            queue_handler.send_latest('u', replay=False)
 
-def open_or_refresh_frontend():
+
+async def set_secondary_subs(state, secondary_task):
+    try:
+        state.set_secondary_subs(await secondary_task)
+    except SubtitleLoadError:
+        pass
+
+
+async def open_or_refresh_frontend():
     mpv.show_text('Opening in Browser...', 2.0)
 
     open_new_tab = False
 
-    with queue_handler.data_queues_lock:
-        finalize_queues = queue_handler.data_queues
-
-        if config.reuse_last_tab and len(queue_handler.data_queues) > 0:
-            # Refresh last opened queue
-            queue_handler.data_queues[-1].put('r')
-            # Remove it from the finalize queues (all but last)
-            finalize_queues = finalize_queues[:-1]
-            # Start a timeout thread to open a new tab if no new request comes in within the timeout
-            t = threading.Thread(target=tab_reload_timeout)
-            t.start()
-        else:
-            open_new_tab = True
+    clients = queue_handler.get_clients()
+    finalize_clients = clients
 
-        # Disconnect all the finalize queues
-        for q in finalize_queues:
-            q.put('q')
+    if config.reuse_last_tab and len(clients) > 0:
+        # Refresh last opened client
+        queue_handler.send_data('r', clients[-1])
+        # Remove it from the finalize clients (all but last)
+        finalize_clients = clients[:-1]
+        # Open a new tab if no new request comes in within the timeout
+        spawn(tab_reload_timeout())
+    else:
+        open_new_tab = True
+
+    # Disconnect all the finalize clients
+    for client in finalize_clients:
+        queue_handler.send_data('q', client)
 
     if open_new_tab:
-        open_webbrowser_new_tab()
+        await run_blocking(open_webbrowser_new_tab)
+
+
+async def open_migaku(*args):
+    async with open_lock:
+        await load_and_open_migaku(*args)
 
 
-def resync_subtitle(resync_sub_path, resync_reference_path, resync_reference_track):
+async def resync_subtitle(resync_sub_path, resync_reference_path, resync_reference_track):
     if executables.ffmpeg is None:
         mpv.show_text('Subtitle syncing requires ffmpeg to be located in the plugin directory.')
         return
+    if executables.ffsubsync is None:
+        mpv.show_text('Subtitle syncing requires ffsubsync to be installed.')
+        return
+
+    if resync_manager.busy():
+        mpv.show_text('Subtitle syncing queued. Please wait...', duration=150.0)
+    else:
+        mpv.show_text('Syncing subtitles to reference track. Please wait...', duration=150.0)
 
-    mpv.show_text('Syncing subtitles to reference track. Please wait...', duration=150.0)
+    # Support drag & drop subtitle files on some systems
+    resync_sub_path = subtitle_manager.subtitle_path_clean(resync_sub_path)
+
+    try:
+        synced_path = await resync_manager.resync(resync_sub_path, resync_reference_path, resync_reference_track)
+    except ResyncCancelledError:
+        mpv.show_text('Syncing cancelled.')
+        return
+    finally:
+        if not resync_manager.busy():
+            queue_handler.send_latest('y')
+
+    if synced_path is not None:
+        mpv.command('sub-add', synced_path)
+        mpv.show_text('Syncing finished.')
+    else:
+        mpv.show_text('Syncing failed.')
+
+
+def send_resync_progress(progress):
+    # Only the latest progress matters, an empty one means no sync is running anymore
+    queue_handler.send_latest('y' + str(progress))
+    mpv.show_text('Syncing subtitles to reference track... %d%%' % progress, duration=150.0)
 
-    # Run actual syncing in thread
-    def sync_thread_func():
-        synced_path = subtitle_manager.resync_subtitle(tmp_dir, executables, resync_sub_path, resync_reference_path,
-                                                       resync_reference_track)
-        if synced_path is not None:
-            mpv.command('sub-add', synced_path)
-            mpv.show_text('Syncing finished.')
-        else:
-            mpv.show_text('Syncing failed.')
 
-    # Start the thread
-    t = threading.Thread(target=sync_thread_func)
-    t.start()
+def cancel_resync():
+    if resync_manager.cancel_all() == 0:
+        mpv.show_text('No subtitle sync is running.')
+
+
+async def prefetch_playlist():
+    # Prefetch subtitles for the entries after the one that is playing now
+    try:
+        props = await mpv.get_properties(['playlist', 'working-directory'])
+    except Exception:
+        return
+    playlist = props['playlist'] or []
+    working_dir = props['working-directory'] or ''
+
+    current = next((i for i, entry in enumerate(playlist) if entry.get('current') or entry.get('playing')), None)
+    if current is None:
+        return
+
+    media_paths = []
+    for entry in playlist[current + 1:current + 1 + config.prefetch_count]:
+        filename = entry.get('filename')
+        if filename:
+            media_paths.append(filename if '://' in filename else os.path.join(working_dir, filename))
+    prefetcher.prefetch(media_paths)
 
 
 def exception_hook(exc_type, exc_value, exc_traceback):
@@ -333,11 +639,16 @@ def install_except_hooks():
 
 def main():
     global log_file
-    global mpv
     global config
     global executables
     global anki_exporter
-    global server
+    global subtitle_cache
+    global cached_tracks_index
+    global extraction_cache
+    global extractor
+    global downloader
+    global resync_cache
+    global prefetcher
 
     install_except_hooks()
 
@@ -375,23 +686,82 @@ def main():
     anki_exporter = AnkiExporter(config, executables)
     print('ANKI:', vars(anki_exporter))
 
+    # Init caches
+    if config.subtitle_cache_size > 0:
+        subtitle_cache = SubtitleCache(os.path.join(cache_dir, 'subs'), config.subtitle_cache_size * 1024 * 1024)
+        cached_tracks_index = CachedTracksIndex(subtitle_cache)
+    if config.extraction_cache_size > 0:
+        extraction_cache = DiskCache(os.path.join(cache_dir, 'extracted'), config.extraction_cache_size * 1024 * 1024)
+        extraction_cache.remove_stale_tmp_files()
+
+    if config.prefetch_count > 0 and (subtitle_cache is not None or extraction_cache is not None):
+        prefetcher = SubtitlePrefetcher(tmp_dir, executables, config, subtitle_cache, extraction_cache)
+
+    # Takes over what the prefetcher is exporting when playback reaches that file
+    extractor = SubtitleExtractor(tmp_dir, executables, config, extraction_cache,
+                                  prefetcher.extractor if prefetcher is not None else None)
+
+    download_cache = None
+    if config.download_cache_size > 0:
+        download_cache = DiskCache(os.path.join(cache_dir, 'downloads'), config.download_cache_size * 1024 * 1024,
+                                   '.sub')
+        download_cache.remove_stale_tmp_files()
+    downloader = Downloader(download_cache)
+
+    if config.resync_cache_size > 0:
+        resync_cache = DiskCache(os.path.join(cache_dir, 'resync'), config.resync_cache_size * 1024 * 1024, '.npz')
+        resync_cache.remove_stale_tmp_files()
+
+    asyncio.run(run(sys.argv[1]))
+
+    # Don't leave ffmpeg running
+    extractor.cancel()
+    kill_streaming_processes()
+    if prefetcher is not None:
+        prefetcher.cancel()
+    if cached_tracks_index is not None:
+        cached_tracks_index.close()
+    downloader.close()
+
+    # Delete temp dir
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+async def run(ipc_handle_path):
+    global mpv
+    global server
+    global resync_manager
+
     # Init mpv IPC
-    mpv = MpvIpc(sys.argv[1])
+    mpv = MpvIpcAsync()
+    await mpv.open(ipc_handle_path)
+
+    # The browser applies the subtitle delay itself, changes are forwarded as they happen
+    mpv.command('observe_property', 1, 'sub-delay')
 
-    # Setup server
+    resync_manager = ResyncManager(tmp_dir, executables, resync_cache, max(config.resync_max_jobs, 1),
+                                   send_resync_progress)
+
+    # Setup server, it shares the loop with everything else
     server = HttpServer(config.host, range(config.port, config.port_max + 1))
     server.set_get_file_server('/', plugin_dir + '/index.html')
     for path in ['/icons/migakufavicon.png', '/icons/anki.png', '/icons/bigsearch.png']:
         server.set_get_file_server(path, plugin_dir + path)
-    server.set_get_handler('/subs', get_handler_subs)
-    server.set_get_handler('/secondary_subs', get_handler_secondary_subs)
+    # Serializing runs there if the subs changed since they were last prepared
+    server.set_get_handler('/subs', get_handler_subs, blocking=True)
+    server.set_get_handler('/secondary_subs', get_handler_secondary_subs, blocking=True)
     server.set_get_handler('/data', get_handler_data)
-    server.set_post_handler('/anki', post_handler_anki)
+    server.set_get_handler('/search', get_handler_search, blocking=True)
+    server.set_post_handler('/anki', post_handler_anki, blocking=True)
     server.set_post_handler('/mpv_control', post_handler_mpv_control)
-    server.open()
-
-    # Main loop, exits when IPC connection closes
-    for data in mpv.listen():
+    server.set_post_handler('/resync_cancel', post_handler_resync_cancel)
+    server.set_websocket_handler('/control', websocket_open_handler_control, websocket_message_handler_control)
+    await server.start()
+    queue_handler.on_data = server.notify_streams
+
+    # Main loop, exits when IPC connection closes. Anything that takes a while runs as its own task so events keep
+    # being processed (replies to requests included).
+    async for data in mpv.listen():
         print('MPV:', data)
         if ('event' in data) and (data['event'] == 'client-message'):
             event_args = data.get('args', [])
@@ -400,21 +770,32 @@ def main():
                 if cmd == 'sub-start':
                     send_subtitle_time(event_args[2])
                 elif cmd == 'open':
-                    load_and_open_migaku(*event_args[2:9 + 1])
+                    spawn(open_migaku(*event_args[2:9 + 1]))
                 elif cmd == 'resync':
-                    resync_subtitle(*event_args[2:4 + 1])
+                    spawn(resync_subtitle(*event_args[2:4 + 1]))
+                elif cmd == 'resync-cancel':
+                    cancel_resync()
+                elif cmd == 'file-loaded':
+                    extractor.start(event_args[2], event_args[3:])
+                    if prefetcher is not None:
+                        spawn(prefetch_playlist())
+        elif ('event' in data) and (data['event'] == 'property-change'):
+            if data.get('name') == 'sub-delay' and data.get('data') is not None:
+                send_subs_delay(data['data'])
+
+    # Don't leave ffsubsync running
+    resync_manager.cancel_all()
+
+    # Disconnect all clients
+    queue_handler.send_data('q')
 
     # Close server
-    server.close()
-
-    # Disconnect all queues
-    queue_handler.send_data('q')
+    await server.stop()
 
     # Close mpv IPC
     mpv.close()
 
-    # Delete temp dir
-    shutil.rmtree(tmp_dir, ignore_errors=True)
+    worker_executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == '__main__':
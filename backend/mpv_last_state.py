@@ -1,6 +1,11 @@
+import itertools
+import threading
 from dataclasses import dataclass, field
 
-from subtitle_manager import Sub
+from subtitle_track import SubtitleTrack
+
+# Source of state versions, every state and every change to it gets a new one
+_versions = itertools.count(1)
 
 
 @dataclass
@@ -10,5 +15,28 @@ class MpvLastState:
     subs_delay: int = 0
     resx: int = 1920
     resy: int = 1080
-    subs: list[Sub] = field(default_factory=lambda: [])
-    secondary_subs: list[Sub] = field(default_factory=lambda: [])
+    subs: SubtitleTrack = field(default_factory=SubtitleTrack)
+    secondary_subs: SubtitleTrack = field(default_factory=SubtitleTrack)
+    # Used to cache anything derived from the subtitles, the setters give the state a new one
+    version: int = field(default_factory=lambda: next(_versions))
+    # The subs are changed on the event loop and read on worker threads, see snapshot()
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def snapshot(self) -> tuple[int, SubtitleTrack, SubtitleTrack]:
+        # (version, subs, secondary subs) read together, so the version always belongs to the subs
+        with self.lock:
+            return self.version, self.subs, self.secondary_subs
+
+    # The setters keep the secondary ranges of the primary subs up to date, they depend on both lists
+
+    def set_subs(self, subs: SubtitleTrack):
+        with self.lock:
+            self.subs = subs
+            self.subs.link_secondary(self.secondary_subs)
+            self.version = next(_versions)
+
+    def set_secondary_subs(self, secondary_subs: SubtitleTrack):
+        with self.lock:
+            self.secondary_subs = secondary_subs
+            self.subs.link_secondary(self.secondary_subs)
+            self.version = next(_versions)
@@ -1,20 +1,141 @@
+import os
 import threading
 
 
+class DataClient:
+    def __init__(self, client_id: int, cursor: int):
+        self.client_id = client_id
+        # Sequence number of the next event this client reads
+        self.cursor = cursor
+        # Event type -> version of the latest value this client has read
+        self.latest_versions: dict[str, int] = {}
+
+
 class QueueHandler:
-    def __init__(self):
-        self.data_queues = []
-        self.data_queues_lock = threading.Lock()
-
-    def add_queue(self, q):
-        with self.data_queues_lock:
-            self.data_queues.append(q)
-
-    def remove_queue(self, q):
-        with self.data_queues_lock:
-            self.data_queues.remove(q)
-
-    def send_data(self, data):
-        with self.data_queues_lock:
-            for q in self.data_queues:
-                q.put(data)
+    # Broadcast ring buffer for the data streams. Every event gets a sequence number and each client reads from its
+    # own cursor, so memory stays bounded no matter how many clients there are or how slow they read. Clients that
+    # fall further behind than the ring capacity skip the events they missed.
+    #
+    # Events sent with send_latest() are coalesced instead: only the latest value per event type is kept, a client
+    # that did not read a value before it got replaced never sees it. State like the playback position is replayed to
+    # clients that connect later, notifications only reach the clients that were connected when they were sent.
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        # Slot seq % capacity holds (seq, data, target client id or None for all clients)
+        self.ring = [None] * capacity
+        self.next_seq = 1
+        self.clients: list[DataClient] = []
+        # Event type -> (version, data, next_seq when it was sent, replay) of coalesced events
+        self.latest: dict[str, tuple[int, str, int, bool]] = {}
+        self.latest_version = 0
+        self.next_client_id = 1
+        self.lock = threading.Lock()
+        # Event ids from an earlier backend run must not be mistaken for ours
+        self.stream_id = os.urandom(4).hex()
+        # Called after data was queued, used to wake up the consumers
+        self.on_data = None
+
+    def add_client(self, last_event_id: str | None = None) -> DataClient:
+        with self.lock:
+            client_id = None
+            cursor = self.next_seq
+
+            # Resume a reconnecting client where it left off, including events that were targeted at it
+            resume = self._parse_event_id(last_event_id)
+            if resume is not None:
+                resume_client_id, resume_seq = resume
+                if all(c.client_id != resume_client_id for c in self.clients):
+                    client_id = resume_client_id
+                    cursor = max(resume_seq + 1, self.next_seq - self.capacity)
+
+            if client_id is None:
+                client_id = self.next_client_id
+                self.next_client_id += 1
+
+            client = DataClient(client_id, cursor)
+            # Notifications sent before the client connected are not for it, a reconnecting client only gets those
+            # that were sent after events it missed
+            for event_type, (version, _, seq, replay) in self.latest.items():
+                if not replay and seq <= cursor:
+                    client.latest_versions[event_type] = version
+            self.clients.append(client)
+            return client
+
+    def initial_event_id(self, client: DataClient) -> str:
+        # Sent to the client when it connects, a reconnect with it resumes from there even if the client did not
+        # receive any event before
+        with self.lock:
+            return self._event_id(client.client_id, client.cursor - 1)
+
+    def remove_client(self, client: DataClient):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def get_clients(self) -> list[DataClient]:
+        with self.lock:
+            return list(self.clients)
+
+    def send_data(self, data: str, target: DataClient | None = None):
+        with self.lock:
+            seq = self.next_seq
+            self.ring[seq % self.capacity] = (seq, data, None if target is None else target.client_id)
+            self.next_seq = seq + 1
+        self._notify()
+
+    def send_latest(self, data: str, replay: bool = True):
+        # Coalesced event, the type is the first character. Without replay it is a notification that clients
+        # connecting later don't get.
+        with self.lock:
+            self.latest_version += 1
+            self.latest[data[0]] = (self.latest_version, data, self.next_seq, replay)
+        self._notify()
+
+    def read(self, client: DataClient) -> list[tuple[str | None, str]]:
+        # Returns (event id, data) for all events the client has not read yet in the order they were sent. Coalesced
+        # events have no id as they can't be resumed.
+        with self.lock:
+            oldest_seq = max(1, self.next_seq - self.capacity)
+            if client.cursor < oldest_seq:
+                print('DATA: Client %d lagged behind, skipped %d events' %
+                      (client.client_id, oldest_seq - client.cursor))
+                client.cursor = oldest_seq
+
+            # (seq, 1, 0, event) of ring events and (next_seq when sent, 0, version, event) of coalesced ones, a
+            # coalesced event goes before the ring event that was sent after it
+            events = []
+            for seq in range(client.cursor, self.next_seq):
+                _, data, target_id = self.ring[seq % self.capacity]
+                if target_id is None or target_id == client.client_id:
+                    events.append((seq, 1, 0, (self._event_id(client.client_id, seq), data)))
+            client.cursor = self.next_seq
+
+            for event_type, (version, data, seq, _) in self.latest.items():
+                if client.latest_versions.get(event_type, 0) < version:
+                    client.latest_versions[event_type] = version
+                    events.append((seq, 0, version, (None, data)))
+
+            events.sort(key=lambda e: e[:3])
+            return [event for *_, event in events]
+
+    def _event_id(self, client_id: int, seq: int) -> str:
+        return '%s.%d.%d' % (self.stream_id, client_id, seq)
+
+    def _parse_event_id(self, event_id: str | None) -> tuple[int, int] | None:
+        if not event_id:
+            return None
+        parts = event_id.split('.')
+        if len(parts) != 3 or parts[0] != self.stream_id:
+            return None
+        try:
+            client_id, seq = int(parts[1]), int(parts[2])
+        except ValueError:
+            return None
+        if seq >= self.next_seq:
+            return None
+        return client_id, seq
+
+    def _notify(self):
+        if self.on_data is not None:
+            self.on_data()
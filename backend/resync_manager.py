@@ -0,0 +1,179 @@
+import asyncio
+import itertools
+import os
+import pathlib
+import re
+import subprocess
+from typing import Callable
+
+from executables import Executables
+from utils.disk_cache import DiskCache
+
+
+class ResyncCancelledError(Exception):
+    pass
+
+
+class ResyncJob:
+
+    def __init__(self, job_id: int, sub_path: str, reference_path: str, reference_track: str):
+        self.job_id = job_id
+        self.sub_path = sub_path
+        self.reference_path = reference_path
+        self.reference_track = reference_track
+        self.process: asyncio.subprocess.Process | None = None
+        self.cancelled = False
+        self.progress = -1
+
+
+class ResyncManager:
+    # Runs ffsubsync jobs on the event loop, at most max_jobs at a time while the others wait in line. Progress is
+    # parsed from the progress bars ffsubsync prints to stderr.
+    #
+    # With a reference cache, the speech ffsubsync detects in a reference is serialized into it and later jobs with the
+    # same reference file and track pass that to ffsubsync instead of having it analyse the audio again.
+
+    PROGRESS_RE = re.compile(rb'(\d{1,3})%\|')
+
+    # References ffsubsync reads as subtitles instead of extracting speech from them
+    SUBTITLE_EXTENSIONS = {'.srt', '.ass', '.ssa', '.sub', '.vtt'}
+
+    def __init__(self, tmp_dir: str, executables: Executables, reference_cache: DiskCache | None = None,
+                 max_jobs: int = 1, on_progress: Callable[[int], None] | None = None):
+        self.tmp_dir = tmp_dir
+        self.executables = executables
+        self.reference_cache = reference_cache
+        self.on_progress = on_progress
+        self.semaphore = asyncio.Semaphore(max_jobs)
+        self.jobs: dict[int, ResyncJob] = {}
+        self._job_ids = itertools.count(1)
+
+    def busy(self) -> bool:
+        return len(self.jobs) > 0
+
+    async def resync(self, sub_path: str, reference_path: str, reference_track: str) -> str | None:
+        # Returns the path of the synced subtitle file, None if syncing failed, raises ResyncCancelledError
+        job = ResyncJob(next(self._job_ids), sub_path, reference_path, reference_track)
+        self.jobs[job.job_id] = job
+        try:
+            async with self.semaphore:
+                if job.cancelled:
+                    raise ResyncCancelledError()
+                out_path = await self._run(job)
+                if job.cancelled:
+                    raise ResyncCancelledError()
+                return out_path
+        finally:
+            del self.jobs[job.job_id]
+
+    def cancel_all(self) -> int:
+        # Returns the number of cancelled jobs, queued ones included
+        for job in self.jobs.values():
+            job.cancelled = True
+            if job.process is not None and job.process.returncode is None:
+                print('RSYNC: Cancelling job', job.job_id)
+                try:
+                    job.process.kill()
+                except ProcessLookupError:
+                    pass
+        return len(self.jobs)
+
+    def _output_path(self, sub_path: str) -> str:
+        path_ext_split = os.path.splitext(sub_path)  # [path_without_extension, extension_with_dot]
+
+        name = pathlib.Path(sub_path).stem  # Get file name without extension
+        out_base_path = self.tmp_dir + '/' + name + '-resynced'  # Out path without index or extension
+        out_path = out_base_path + path_ext_split[1]
+
+        # If the out path already exists count up until free file is found
+        try_i = 1
+        while os.path.exists(out_path):
+            out_path = out_base_path + '-' + str(try_i) + path_ext_split[1]
+            try_i += 1
+
+        return out_path
+
+    def _reference_key(self, job: ResyncJob) -> str | None:
+        # Subtitle references are quick to read, only the speech detected in media files is cached
+        if self.reference_cache is None or '://' in job.reference_path or \
+                os.path.splitext(job.reference_path)[1].lower() in self.SUBTITLE_EXTENSIONS:
+            return None
+        try:
+            st = os.stat(job.reference_path)
+        except OSError:
+            return None
+        return DiskCache.make_key(os.path.abspath(job.reference_path), st.st_size, st.st_mtime_ns,
+                                  job.reference_track)
+
+    def _link_reference(self, key: str, reference_path: str) -> str | None:
+        # ffsubsync writes the serialized speech next to the reference with the extension replaced, so it gets the
+        # reference under a name in the cache directory that makes it write to the cache entry. Links left behind
+        # by a crash end in .tmp and get removed with the stale temporary files.
+        link_path = os.path.join(self.reference_cache.cache_dir, key + '.tmp')
+        for link in [os.symlink, os.link]:
+            try:
+                link(os.path.abspath(reference_path), link_path)
+                return link_path
+            except OSError:
+                pass
+        return None
+
+    async def _run(self, job: ResyncJob) -> str | None:
+        out_path = self._output_path(job.sub_path)
+        args = [self.executables.ffsubsync]
+
+        key = self._reference_key(job)
+        cached_reference = self.reference_cache.get(key) if key is not None else None
+        link_path = None
+        if cached_reference is not None:
+            print('RSYNC: Using cached reference speech of', job.reference_path)
+            args.append(cached_reference)
+        else:
+            if key is not None:
+                link_path = self._link_reference(key, job.reference_path)
+            if link_path is not None:
+                args += [link_path, '--serialize-speech']
+            else:
+                args.append(job.reference_path)
+            args += ['--reftrack', job.reference_track]
+        args += ['-i', job.sub_path, '-o', out_path, '--ffmpeg-path', os.path.dirname(self.executables.ffmpeg)]
+
+        try:
+            job.process = await asyncio.create_subprocess_exec(
+                *args, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            await self._read_progress(job)
+            r = await job.process.wait()
+        finally:
+            if link_path is not None:
+                try:
+                    os.remove(link_path)
+                except OSError:
+                    pass
+
+        if link_path is not None:
+            # A killed ffsubsync may have left half of the speech behind
+            if r != 0 or job.cancelled:
+                self.reference_cache.remove(key)
+            elif os.path.isfile(self.reference_cache.path_for(key)):
+                self.reference_cache.evict()
+
+        print('RSYNC: Job %d finished (code %d)' % (job.job_id, r))
+        if r == 0 and os.path.isfile(out_path):
+            return out_path
+        return None
+
+    async def _read_progress(self, job: ResyncJob):
+        # Progress bars are redrawn with \r, everything else is passed on to the log
+        buffer = b''
+        while chunk := await job.process.stderr.read(4096):
+            *lines, buffer = re.split(rb'[\r\n]', buffer + chunk)
+            for line in lines:
+                m = self.PROGRESS_RE.search(line)
+                if m is not None:
+                    progress = min(int(m.group(1)), 100)
+                    if progress != job.progress:
+                        job.progress = progress
+                        if self.on_progress is not None:
+                            self.on_progress(progress)
+                elif line.strip():
+                    print('RSYNC:', line.decode('utf-8', errors='replace'))
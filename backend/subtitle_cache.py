@@ -0,0 +1,132 @@
+import hashlib
+import os
+import struct
+import sys
+from array import array
+from typing import Callable, Iterator
+
+from utils.disk_cache import DiskCache
+
+# (text, start, end) as parsed from the file, before delay and filtering are applied
+CacheEntry = tuple[str, int, int]
+
+
+class SubtitleCache:
+    # Persistent cache of parsed subtitle files, so opening the same file again skips detection and parsing.
+    #
+    # Entries are stored as: header (magic, format version, cue count, encoding length, source length), encoding, source
+    # (where the subs came from, shown in search results), start times and end times as int64 arrays, text lengths as
+    # uint32 array, then all texts as one utf-8 blob.
+
+    MAGIC = b'MGSC'
+    # Bumped whenever the stored data or how it is parsed changes
+    FORMAT_VERSION = 5
+    HEADER = struct.Struct('<4sHIBH')
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.disk_cache = DiskCache(cache_dir, max_size, '.subs')
+        self.disk_cache.remove_stale_tmp_files()
+        # Called with (key, entries, source) after an entry was stored
+        self.on_store: Callable[[str, list[CacheEntry], str], None] | None = None
+
+    def set_listener(self, on_store: Callable[[str, list[CacheEntry], str], None], on_remove: Callable[[str], None]):
+        # on_remove is called with the key of every entry that gets removed or evicted
+        self.on_store = on_store
+        self.disk_cache.on_remove = on_remove
+
+    def contains(self, key: str) -> bool:
+        return os.path.isfile(self.disk_cache.path_for(key))
+
+    @staticmethod
+    def key_for(data: bytes, variant: str = '') -> str:
+        # Keyed by content only, so the same file under another path or with a touched mtime still hits.
+        # Variant separates different parsing modes.
+        content_hash = hashlib.blake2b(data, digest_size=16).digest()
+        return DiskCache.make_key(len(data), content_hash, variant)
+
+    def load(self, key: str) -> tuple[str, list[CacheEntry], str] | None:
+        # Returns (encoding, entries, source)
+        data = self.disk_cache.get_bytes(key)
+        if data is None:
+            return None
+        try:
+            return self.decode(data)
+        except (ValueError, struct.error, UnicodeDecodeError):
+            print('SUBS: Dropping corrupt cache entry', key)
+            self.disk_cache.remove(key)
+            return None
+
+    def store(self, key: str, encoding: str, entries: list[CacheEntry], source: str = ''):
+        try:
+            self.disk_cache.put_bytes(key, self.encode(encoding, entries, source))
+        except OSError as e:
+            print('SUBS: Writing cache entry failed:', e)
+            return
+        if self.on_store is not None:
+            self.on_store(key, entries, source)
+
+    def all_tracks(self) -> Iterator[tuple[str, str, list[CacheEntry]]]:
+        # (key, source, entries) of every cached file, read one at a time. Reading them doesn't count as use.
+        for path, _, _ in self.disk_cache.entries():
+            try:
+                with open(path, 'rb') as f:
+                    _, entries, source = self.decode(f.read())
+            except (OSError, ValueError, struct.error, UnicodeDecodeError):
+                continue
+            yield self.disk_cache.key_for_path(path), source, entries
+
+    @classmethod
+    def encode(cls, encoding: str, entries: list[CacheEntry], source: str = '') -> bytes:
+        encoding_bytes = encoding.encode('ascii', errors='replace')[:255]
+        source_bytes = source.encode('utf-8')[:65535].decode('utf-8', errors='ignore').encode('utf-8')
+        texts = [text.encode('utf-8') for text, _, _ in entries]
+        starts = array('q', (start for _, start, _ in entries))
+        ends = array('q', (end for _, _, end in entries))
+        text_lengths = array('I', (len(t) for t in texts))
+        if sys.byteorder != 'little':
+            for a in (starts, ends, text_lengths):
+                a.byteswap()
+
+        return b''.join([
+            cls.HEADER.pack(cls.MAGIC, cls.FORMAT_VERSION, len(entries), len(encoding_bytes), len(source_bytes)),
+            encoding_bytes,
+            source_bytes,
+            starts.tobytes(),
+            ends.tobytes(),
+            text_lengths.tobytes(),
+            b''.join(texts),
+        ])
+
+    @classmethod
+    def decode(cls, data: bytes) -> tuple[str, list[CacheEntry], str]:
+        magic, version, count, encoding_len, source_len = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.FORMAT_VERSION:
+            raise ValueError('Unknown subtitle cache format')
+
+        pos = cls.HEADER.size
+        encoding = data[pos:pos + encoding_len].decode('ascii')
+        pos += encoding_len
+        source = data[pos:pos + source_len].decode('utf-8')
+        pos += source_len
+
+        columns = []
+        for typecode in ['q', 'q', 'I']:
+            column = array(typecode)
+            size = column.itemsize * count
+            column.frombytes(data[pos:pos + size])
+            if len(column) != count:
+                raise ValueError('Subtitle cache entry is truncated')
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            pos += size
+        starts, ends, text_lengths = columns
+
+        entries = []
+        for start, end, text_length in zip(starts, ends, text_lengths):
+            entries.append((data[pos:pos + text_length].decode('utf-8'), start, end))
+            pos += text_length
+        if pos != len(data):
+            raise ValueError('Subtitle cache entry has trailing data')
+
+        return encoding, entries, source
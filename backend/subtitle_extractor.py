@@ -0,0 +1,208 @@
+import os
+import pathlib
+import platform
+import subprocess
+import threading
+
+import psutil
+
+from config import Config
+from executables import Executables
+from utils.disk_cache import DiskCache
+
+# Internal subtitle codecs that can be exported, with the ffmpeg output format
+SUPPORTED_CODECS = {
+    'subrip': 'srt',
+    'ass': 'ass',
+}
+
+
+def extraction_cache_key(media_path: str, track: str, sub_codec: str, sub_format: str | None = None) -> str | None:
+    # Only local files have a stable identity. Tracks converted to another format than the one of their codec (like
+    # ASS streamed as SRT) are cached separately.
+    if '://' in media_path:
+        return None
+    try:
+        st = os.stat(media_path)
+    except OSError:
+        return None
+    parts = [os.path.abspath(media_path), st.st_size, st.st_mtime_ns, track, sub_codec]
+    if sub_format is not None and sub_format != SUPPORTED_CODECS.get(sub_codec):
+        parts.append(sub_format)
+    return DiskCache.make_key(*parts)
+
+
+def set_process_priority(process: subprocess.Popen, low: bool):
+    # Idle CPU and IO priority for background work, normal priority again if somebody waits for it
+    try:
+        ps_process = psutil.Process(process.pid)
+        if platform.system() == 'Windows':
+            ps_process.nice(psutil.IDLE_PRIORITY_CLASS if low else psutil.NORMAL_PRIORITY_CLASS)
+        else:
+            # Unprivileged processes can't raise the priority again on Unix
+            if low:
+                ps_process.nice(19)
+            if hasattr(ps_process, 'ionice'):
+                ps_process.ionice(psutil.IOPRIO_CLASS_IDLE if low else psutil.IOPRIO_CLASS_NONE)
+    except (psutil.Error, OSError):
+        pass
+
+
+class _ExtractionJob:
+
+    def __init__(self, media_path: str, tracks: list[tuple[str, str]]):
+        self.media_path = media_path
+        self.tracks = tracks
+        # (track, codec) -> exported path, filled in when the job finished
+        self.results: dict[tuple[str, str], str] = {}
+        self.done = threading.Event()
+        self.cancelled = False
+        self.process: subprocess.Popen | None = None
+
+
+class SubtitleExtractor:
+    # Exports all internal subtitle tracks of a media file with one ffmpeg run in the background, so the container is
+    # only demuxed once and the tracks are ready when Migaku is opened. Runs at low priority to not disturb playback.
+    #
+    # If the peer extractor (the one of the prefetcher) is already exporting the tracks of a file, its job is adopted
+    # instead of demuxing the file a second time.
+
+    def __init__(self, tmp_dir: str, executables: Executables, config: Config,
+                 extraction_cache: DiskCache | None = None, peer: 'SubtitleExtractor | None' = None):
+        self.tmp_dir = tmp_dir
+        self.peer = peer
+        self.executables = executables
+        self.config = config
+        self.extraction_cache = extraction_cache
+        self.lock = threading.Lock()
+        self.job: _ExtractionJob | None = None
+
+    def start(self, media_path: str, tracks: list[str]):
+        # Tracks are given as '<ff-index>*<codec>' like the sub info sent on open
+        if not self.executables.ffmpeg or '://' in media_path:
+            return
+
+        parsed_tracks = []
+        for track_info in tracks:
+            track, _, sub_codec = track_info.partition('*')
+            if track and sub_codec in SUPPORTED_CODECS:
+                parsed_tracks.append((track, sub_codec))
+
+        peer_job = self.peer.running_job(media_path, parsed_tracks) if self.peer is not None else None
+        job = peer_job or _ExtractionJob(media_path, parsed_tracks)
+        with self.lock:
+            if self.job is not job:
+                self._cancel_locked()
+            self.job = job
+        if peer_job is not None:
+            print('EXTR: Adopting running export of', media_path)
+            return
+        threading.Thread(target=self._run, args=(job,), name='SubtitleExtractor', daemon=True).start()
+
+    def running_job(self, media_path: str, tracks: list[tuple[str, str]]) -> _ExtractionJob | None:
+        # The job exporting the given tracks of the file if it is still running
+        with self.lock:
+            job = self.job
+        if job is None or job.cancelled or job.done.is_set() or job.media_path != media_path or \
+                not all(track_info in job.tracks for track_info in tracks):
+            return None
+        return job
+
+    def cancel(self):
+        with self.lock:
+            self._cancel_locked()
+
+    def _cancel_locked(self):
+        job = self.job
+        if job is None:
+            return
+        self.job = None
+        job.cancelled = True
+        if job.process is not None and job.process.poll() is None:
+            print('EXTR: Cancelling export of', job.media_path)
+            job.process.kill()
+
+    def exported(self, media_path: str, track: str, sub_codec: str) -> bool:
+        # True if the background job is done and exported the track successfully
+        with self.lock:
+            job = self.job
+        return job is not None and job.media_path == media_path and job.done.is_set() and \
+            (track, sub_codec) in job.results
+
+    def wait_for(self, media_path: str, track: str, sub_codec: str, timeout: float | None = None,
+                 raise_priority: bool = True) -> str | None:
+        # Returns the exported path if the background job covers the track, None if it does not or failed
+        with self.lock:
+            job = self.job
+        if job is None or job.media_path != media_path or (track, sub_codec) not in job.tracks:
+            return None
+
+        if not job.done.is_set():
+            print('EXTR: Waiting for background export of track', track)
+            # Somebody is waiting now, low priority would only slow things down
+            if raise_priority:
+                self._set_priority(job, False)
+            if not job.done.wait(timeout):
+                return None
+
+        return job.results.get((track, sub_codec))
+
+    def _set_priority(self, job: _ExtractionJob, low: bool):
+        if job.process is not None:
+            set_process_priority(job.process, low)
+
+    def _output_path(self, job: _ExtractionJob, track: str, sub_codec: str) -> tuple[str | None, str]:
+        # Returns the cache key (None if not cached) and the path ffmpeg should write to
+        cache_key = None
+        if self.extraction_cache is not None:
+            cache_key = extraction_cache_key(job.media_path, track, sub_codec)
+        if cache_key is not None:
+            return cache_key, self.extraction_cache.path_for(cache_key) + '.%d.tmp' % threading.get_ident()
+        stem = pathlib.Path(job.media_path).stem
+        return None, os.path.join(self.tmp_dir, '%s.%s.%s' % (stem, track, SUPPORTED_CODECS[sub_codec]))
+
+    def _run(self, job: _ExtractionJob):
+        outputs = []
+        args = [self.executables.ffmpeg, '-y', '-loglevel', 'error', '-i', job.media_path]
+
+        for track, sub_codec in job.tracks:
+            if self.extraction_cache is not None:
+                cache_key = extraction_cache_key(job.media_path, track, sub_codec)
+                if cache_key is not None:
+                    cached_path = self.extraction_cache.get(cache_key)
+                    if cached_path is not None:
+                        job.results[(track, sub_codec)] = cached_path
+                        continue
+
+            cache_key, output_path = self._output_path(job, track, sub_codec)
+            outputs.append((track, sub_codec, cache_key, output_path))
+            args += ['-map', '0:' + track, '-f', SUPPORTED_CODECS[sub_codec], output_path]
+
+        try:
+            if outputs:
+                print('EXTR: Exporting %d tracks of %s' % (len(outputs), job.media_path))
+                with self.lock:
+                    if job.cancelled:
+                        return
+                    job.process = subprocess.Popen(args, stdin=subprocess.DEVNULL)
+                self._set_priority(job, True)
+                r = job.process.wait()
+
+                for track, sub_codec, cache_key, output_path in outputs:
+                    if job.cancelled or r != 0 or not os.path.isfile(output_path):
+                        continue
+                    if cache_key is not None:
+                        output_path = self.extraction_cache.put_file(cache_key, output_path)
+                    job.results[(track, sub_codec)] = output_path
+
+                print('EXTR: Export finished (code %d, cancelled: %s)' % (r, job.cancelled))
+        except Exception as e:
+            print('EXTR: Export failed:', e)
+        finally:
+            for _, _, cache_key, output_path in outputs:
+                if cache_key is not None and os.path.isfile(output_path):
+                    try:
+                        os.remove(output_path)
+                    except OSError:
+                        pass
+            job.done.set()
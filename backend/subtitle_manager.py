@@ -2,28 +2,26 @@ import codecs
 import os
 import pathlib
 import subprocess
+import threading
 import time
 import urllib.parse
 import urllib.request
-from dataclasses import dataclass
+from typing import Callable
 
 import cchardet as chardet
 import pysubs2
-import requests
-
+import subtitle_parser
 from config import Config
 from executables import Executables
-from utils.mpv_ipc import MpvIpc
-
+from subtitle_cache import SubtitleCache, CacheEntry
+from subtitle_extractor import SubtitleExtractor, SUPPORTED_CODECS, extraction_cache_key
+from subtitle_track import SubtitleTrack
+from utils.disk_cache import DiskCache
+from utils.downloader import Downloader
+from utils.mpv_ipc import MpvIpcAsync
 
-@dataclass
-class Sub:
-    text: str
-    start: int
-    end: int
 
-
-def _subtitle_path_clean(path: str) -> str:
+def subtitle_path_clean(path: str) -> str:
     if path.startswith('file:'):
         uri_path = urllib.parse.urlparse(path).path
         return urllib.request.url2pathname(uri_path)
@@ -34,42 +32,279 @@ class SubtitleLoadError(Exception):
     pass
 
 
+def _remaining(deadline: float | None) -> float | None:
+    return None if deadline is None else deadline - time.monotonic()
+
+
 def _dump_internal_subs(
-        mpv: MpvIpc, tmp_dir: str, executables: Executables, config: Config, media_path: str,
-        track: str, sub_codec: str
+        mpv: MpvIpcAsync, tmp_dir: str, executables: Executables, config: Config, media_path: str,
+        track: str, sub_codec: str, extraction_cache: DiskCache | None = None,
+        extractor: SubtitleExtractor | None = None
 ) -> str:
-    if sub_codec in ['subrip', 'ass']:
+    if sub_codec in SUPPORTED_CODECS:
+        cached_path = _cached_internal_track(media_path, track, sub_codec, extraction_cache)
+        if cached_path is not None:
+            print('SUBS: Using extracted track from cache:', cached_path)
+            return cached_path
+        cache_key = None
+        if extraction_cache is not None:
+            cache_key = extraction_cache_key(media_path, track, sub_codec)
+
         if not executables.ffmpeg:
             raise SubtitleLoadError(
                 'Using internal subtitles requires ffmpeg to be located in the plugin directory.')
         mpv.show_text('Exporting internal subtitle track...', duration=150.0)  # Next osd message will close it
-        if sub_codec == 'subrip':
-            sub_extension = 'srt'
+        # Waiting for the background export and exporting here share the timeout
+        deadline = None
+        if config.subtitle_export_timeout > 0:
+            deadline = time.monotonic() + config.subtitle_export_timeout
+
+        # Exported in the background since the file was loaded?
+        if extractor is not None:
+            sub_path = extractor.wait_for(media_path, track, sub_codec, _remaining(deadline))
+            if sub_path is not None:
+                return sub_path
+
+        timeout = _remaining(deadline)
+        if timeout is not None and timeout <= 0:
+            raise SubtitleLoadError('Exporting internal subtitle track timed out.')
+
+        sub_extension = SUPPORTED_CODECS[sub_codec]
+        if cache_key is not None:
+            # Format is given explicitly as the temporary file has no usable extension
+            sub_path = extraction_cache.path_for(cache_key) + '.%d.tmp' % threading.get_ident()
         else:
-            sub_extension = sub_codec
-        sub_path = tmp_dir + '/' + str(pathlib.Path(media_path).stem) + '.' + sub_extension
-        args = [executables.ffmpeg, '-y', '-loglevel', 'error', '-i', media_path, '-map', '0:' + track, sub_path]
+            # Primary and secondary subs may be exported at the same time
+            sub_path = os.path.join(tmp_dir, '%s.%s.%s' % (pathlib.Path(media_path).stem, track, sub_extension))
+        args = [executables.ffmpeg, '-y', '-loglevel', 'error', '-i', media_path, '-map', '0:' + track,
+                '-f', sub_extension, sub_path]
         try:
-            timeout = config.subtitle_export_timeout if config.subtitle_export_timeout > 0 else None
-            subprocess.run(args, timeout=timeout)
+            r = subprocess.run(args, timeout=timeout)
             if not os.path.isfile(sub_path):
                 raise FileNotFoundError
+            if cache_key is not None:
+                # Never keep partial output around for later sessions
+                if r.returncode != 0:
+                    raise subprocess.CalledProcessError(r.returncode, args)
+                sub_path = extraction_cache.put_file(cache_key, sub_path)
             return sub_path
-        except TimeoutError:
+        except subprocess.TimeoutExpired:
             raise SubtitleLoadError('Exporting internal subtitle track timed out.')
         except Exception:
             raise SubtitleLoadError('Exporting internal subtitle track failed.')
+        finally:
+            if cache_key is not None and sub_path.endswith('.tmp'):
+                try:
+                    os.remove(sub_path)
+                except OSError:
+                    pass
     else:
         raise SubtitleLoadError(
             'Selected internal subtitle track is not supported.\n\nOnly SRT and ASS tracks are supported.\n\nSelected track is ' + sub_codec)
 
 
-def _determine_subs_encoding(subs_path: str) -> str:
+def _cached_internal_track(
+        media_path: str, track: str, sub_codec: str, extraction_cache: DiskCache | None
+) -> str | None:
+    # Path of the exported track in the extraction cache, in the format of its codec or as SRT if it was streamed
+    if extraction_cache is None:
+        return None
+    for sub_format in [SUPPORTED_CODECS[sub_codec], 'srt']:
+        cache_key = extraction_cache_key(media_path, track, sub_codec, sub_format)
+        if cache_key is None:
+            return None
+        cached_path = extraction_cache.get(cache_key)
+        if cached_path is not None:
+            return cached_path
+    return None
+
+
+def _internal_track_available(
+        media_path: str, track: str, sub_codec: str, extraction_cache: DiskCache | None,
+        extractor: SubtitleExtractor | None
+) -> bool:
+    # True if the track is exported already. While the background export is still running the track is streamed
+    # instead, waiting for the export would show nothing until all tracks are done.
+    if _cached_internal_track(media_path, track, sub_codec, extraction_cache) is not None:
+        return True
+    return extractor is not None and extractor.exported(media_path, track, sub_codec)
+
+
+# ffmpeg processes streaming subtitles, killed when the backend exits
+_streaming_processes: set[subprocess.Popen] = set()
+_streaming_lock = threading.Lock()
+
+
+def _start_srt_stream(args: list[str]) -> subprocess.Popen:
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    with _streaming_lock:
+        _streaming_processes.add(process)
+    return process
+
+
+def _kill_process(process: subprocess.Popen):
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+def kill_streaming_processes():
+    with _streaming_lock:
+        processes = list(_streaming_processes)
+    for process in processes:
+        _kill_process(process)
+
+
+def _read_srt_stream(process: subprocess.Popen, on_data: Callable[[bytes, list[CacheEntry]], None],
+                     timeout: float | None) -> tuple[int, bool]:
+    # Reads the SRT ffmpeg writes to stdout and passes each chunk with the cues completed by it to on_data.
+    # Returns the exit code and whether the timeout was hit.
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        _kill_process(process)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    parser = subtitle_parser.SrtStreamParser()
+    try:
+        while chunk := process.stdout.read1(64 * 1024):
+            on_data(chunk, parser.feed(decoder.decode(chunk)))
+        on_data(b'', parser.feed(decoder.decode(b'', final=True)) + parser.close())
+    finally:
+        process.stdout.close()
+        if timer is not None:
+            timer.cancel()
+        # Don't leave ffmpeg running if reading failed
+        _kill_process(process)
+        r = process.wait()
+        with _streaming_lock:
+            _streaming_processes.discard(process)
+
+    return r, timed_out.is_set()
+
+
+def _stream_internal_subs(
+        executables: Executables, config: Config, media_path: str, track: str, sub_codec: str,
+        extraction_cache: DiskCache | None, on_partial: Callable[[list[CacheEntry]], None],
+        position_hint: int | None
+) -> list[CacheEntry]:
+    # Exports the track through a pipe and reports the cues decoded so far while ffmpeg is still running. If the
+    # playback position is known, a second short export around it makes the lines there show up first.
+    print('SUBS: Streaming internal subtitle track', track)
+
+    # ASS is converted to SRT by ffmpeg, only the plain text is used anyway
+    ffmpeg_args = [executables.ffmpeg, '-y', '-loglevel', 'error']
+    output_args = ['-map', '0:' + track, '-f', 'srt', '-']
+    timeout = config.subtitle_export_timeout if config.subtitle_export_timeout > 0 else None
+
+    lock = threading.Lock()
+    entries: list[CacheEntry] = []
+    window_entries: list[CacheEntry] = []
+    finished = False
+    last_report = 0.0
+
+    def report(force=False):
+        # Called with lock held
+        nonlocal last_report
+        now = time.monotonic()
+        if finished or (not force and now - last_report < 0.25):
+            return
+        last_report = now
+        # Window cues only fill the part the full export did not reach yet
+        last_start = entries[-1][1] if entries else -1
+        partial = entries + [e for e in window_entries if e[1] > last_start]
+        partial.sort(key=lambda e: e[1])
+        on_partial(partial)
+
+    window_process = None
+    if position_hint is not None:
+        window_start = max(position_hint - 30000, 0)
+
+        def on_window_data(_, cues):
+            with lock:
+                # Timestamps start at the seek point
+                window_entries.extend((text, start + window_start, end + window_start) for text, start, end in cues)
+
+        def run_window():
+            try:
+                _read_srt_stream(window_process, on_window_data, timeout)
+            except Exception as e:
+                print('SUBS: Streaming window around position failed:', e)
+                return
+            with lock:
+                report(True)
+
+        try:
+            window_process = _start_srt_stream(
+                ffmpeg_args + ['-ss', '%.3f' % (window_start / 1000), '-i', media_path, '-t', '120'] + output_args)
+            threading.Thread(target=run_window, name='SubtitleWindow', daemon=True).start()
+        except OSError as e:
+            print('SUBS: Streaming window around position failed:', e)
+
+    # The full export is written to the extraction cache as it comes in
+    cache_key = None
+    if extraction_cache is not None:
+        # Cached as SRT, ASS tracks are converted
+        cache_key = extraction_cache_key(media_path, track, sub_codec, 'srt')
+    cache_tmp_path = None
+    cache_file = None
+    if cache_key is not None:
+        cache_tmp_path = extraction_cache.path_for(cache_key) + '.%d.tmp' % threading.get_ident()
+        cache_file = open(cache_tmp_path, 'wb')
+
+    def on_data(chunk, cues):
+        if cache_file is not None:
+            cache_file.write(chunk)
+        if cues:
+            with lock:
+                entries.extend(cues)
+                report()
+
     try:
-        subs_f = open(subs_path, 'rb')
-        subs_data = subs_f.read()
-        subs_f.close()
+        process = _start_srt_stream(ffmpeg_args + ['-i', media_path] + output_args)
+        r, timed_out = _read_srt_stream(process, on_data, timeout)
+        if cache_file is not None:
+            cache_file.close()
+            if r == 0:
+                extraction_cache.put_file(cache_key, cache_tmp_path)
+    except Exception:
+        raise SubtitleLoadError('Exporting internal subtitle track failed.')
+    finally:
+        with lock:
+            finished = True
+        # The window is only useful until the full export is done
+        if window_process is not None:
+            _kill_process(window_process)
+        if cache_file is not None:
+            cache_file.close()
+            try:
+                os.remove(cache_tmp_path)
+            except OSError:
+                pass
+
+    if timed_out:
+        raise SubtitleLoadError('Exporting internal subtitle track timed out.')
+    if r != 0 and not entries:
+        raise SubtitleLoadError('Exporting internal subtitle track failed.')
+
+    entries.sort(key=lambda e: e[1])
+    return entries
 
+
+# Bytes chardet looks at if the subs are neither marked by a BOM nor valid UTF-8
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+
+def _determine_subs_encoding(subs_data: bytes) -> str:
+    try:
         boms_for_enc = [
             ('utf-32', (codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE)),
             ('utf-16', (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)),
@@ -80,9 +315,19 @@ def _determine_subs_encoding(subs_path: str) -> str:
             if any(subs_data.startswith(bom) for bom in boms):
                 print('SUBS: Detected encoding (bom):', enc)
                 return enc
-        else:
-            chardet_ret = chardet.detect(subs_data)
-            print('SUBS: Detected encoding (chardet):', chardet_ret)
+
+        # Most subs are UTF-8, a strict decode is much cheaper than detection and can't give false positives
+        try:
+            subs_data.decode('utf-8')
+            print('SUBS: Detected encoding (valid utf-8)')
+            return 'utf-8'
+        except UnicodeDecodeError:
+            pass
+
+        chardet_ret = chardet.detect(subs_data[:ENCODING_SAMPLE_SIZE])
+        print('SUBS: Detected encoding (chardet):', chardet_ret)
+        if chardet_ret['encoding']:
+            codecs.lookup(chardet_ret['encoding'])
             return chardet_ret['encoding']
     except Exception:
         print('SUBS: Detecting encoding failed. Defaulting to utf-8')
@@ -90,23 +335,39 @@ def _determine_subs_encoding(subs_path: str) -> str:
 
 
 def load_subs_from_info(
-        mpv: MpvIpc, tmp_dir: str, executables: Executables, config: Config, media_path: str,
-        sub_info: str, subs_delay: int
-) -> list[Sub]:
+        mpv: MpvIpcAsync, tmp_dir: str, executables: Executables, config: Config, media_path: str,
+        sub_info: str, subtitle_cache: SubtitleCache | None = None,
+        extraction_cache: DiskCache | None = None, extractor: SubtitleExtractor | None = None,
+        on_partial: Callable[[SubtitleTrack], None] | None = None, position_hint: int | None = None,
+        downloader: Downloader | None = None
+) -> SubtitleTrack:
+    # If on_partial is given, internal tracks that need to be exported are streamed and on_partial receives the subs
+    # decoded so far while that is running. position_hint is the playback position in ms.
+    #
+    # The subs are returned as they are in the file, the subtitle delay is applied by whoever shows them.
+
     # Turn the info into a path
     if '*' in sub_info:
         internal_sub_info = sub_info.split('*')
         if len(internal_sub_info) == 2:
             ffmpeg_track = internal_sub_info[0]
             sub_codec = internal_sub_info[1]
-            sub_path = _dump_internal_subs(mpv, tmp_dir, executables, config, media_path, ffmpeg_track, sub_codec)
+            if (on_partial is not None and executables.ffmpeg and sub_codec in SUPPORTED_CODECS and
+                    not _internal_track_available(media_path, ffmpeg_track, sub_codec, extraction_cache, extractor)):
+                mpv.show_text('Exporting internal subtitle track...', duration=150.0)
+                entries = _stream_internal_subs(
+                    executables, config, media_path, ffmpeg_track, sub_codec, extraction_cache,
+                    lambda partial: on_partial(SubtitleTrack.from_entries(partial, config.skip_empty_subs)), position_hint)
+                return SubtitleTrack.from_entries(entries, config.skip_empty_subs)
+            sub_path = _dump_internal_subs(mpv, tmp_dir, executables, config, media_path, ffmpeg_track, sub_codec,
+                                           extraction_cache, extractor)
+            source = '%s (track %s)' % (media_path, ffmpeg_track)
         else:
             raise SubtitleLoadError('Unknown sub info' + sub_info)
     else:
-        sub_path = sub_info
-
-    # Support drag & drop subtitle files on some systems
-    sub_path = _subtitle_path_clean(sub_path)
+        # Support drag & drop subtitle files on some systems
+        sub_path = subtitle_path_clean(sub_info)
+        source = sub_path
 
     # Web subtitle?
     is_websub = False
@@ -114,26 +375,19 @@ def load_subs_from_info(
         i = sub_path.rfind('http')
         if i >= 0:
             url = sub_path[i:]
+            source = url
 
             try:
-                response = requests.get(url)
                 tmp_sub_path = os.path.join(tmp_dir, 'websub_%d.vtt' % round(time.time() * 1000))
-                with open(tmp_sub_path, 'wb') as f:
-                    f.write(response.content)
-
-                sub_path = tmp_sub_path
+                sub_path = (downloader or Downloader()).download(url, tmp_sub_path)
                 is_websub = True
             except Exception:
                 raise SubtitleLoadError('Downloading web subtitles failed.')
 
     elif sub_path.startswith('http'):
         try:
-            response = requests.get(sub_path)
             tmp_sub_path = os.path.join(tmp_dir, 'websub_%d' % round(time.time() * 1000))
-            with open(tmp_sub_path, 'wb') as f:
-                f.write(response.content)
-
-            sub_path = tmp_sub_path
+            sub_path = (downloader or Downloader()).download(sub_path, tmp_sub_path)
         except Exception:
             raise SubtitleLoadError('Downloading web subtitles failed.')
 
@@ -141,55 +395,59 @@ def load_subs_from_info(
         print('SUBS Not found:', sub_path)
         raise SubtitleLoadError('The subtitle file "%s" was not found.' % sub_path)
 
-    # Determine subs encoding
-    subs_encoding = _determine_subs_encoding(sub_path)
-
-    # Parse subs and generate json for frontend
-    try:
-        with open(sub_path, encoding=subs_encoding, errors='replace') as fp:
-            subs = pysubs2.SSAFile.from_file(fp)
-    except Exception:
-        raise SubtitleLoadError('Loading subtitle file "%s" failed.' % sub_path)
-
-    subs.sort()
-    subs_list = []
-
-    for s in subs:
-        text = s.plaintext.strip()
+    entries = read_subs_file(sub_path, subtitle_cache, is_websub, source)
+    return SubtitleTrack.from_entries(entries, config.skip_empty_subs)
 
-        # Temporary to correct pysubs2 parsing mistakes
-        if is_websub:
-            text = text.split('\n\n')[0]
 
-        if not config.skip_empty_subs or text.strip():
-            sub_start = max(s.start + subs_delay, 0) // 10 * 10
-            sub_end = max(s.end + subs_delay, 0) // 10 * 10
-            subs_list.append(Sub(text, sub_start, sub_end))
+def read_subs_file(sub_path: str, subtitle_cache: SubtitleCache | None = None, is_websub: bool = False,
+                   source: str = '') -> list[CacheEntry]:
+    # Parsed entries of a subtitle file, from the subtitle cache if it has them. Source is stored along with them.
 
-    return subs_list
+    # The file is read once, the bytes are used for the cache key, encoding detection and parsing
+    try:
+        with open(sub_path, 'rb') as f:
+            subs_data = f.read()
+    except OSError:
+        raise SubtitleLoadError('Reading subtitle file "%s" failed.' % sub_path)
+
+    # Use the parsed subs from an earlier session if the file did not change
+    cache_key = None
+    cached = None
+    if subtitle_cache is not None:
+        cache_key = subtitle_cache.key_for(subs_data, 'websub' if is_websub else '')
+        cached = subtitle_cache.load(cache_key)
+
+    if cached is not None:
+        print('SUBS: Loaded from cache:', sub_path)
+        return cached[1]
 
+    # Determine subs encoding
+    subs_encoding = _determine_subs_encoding(subs_data)
+    entries = _parse_subs(sub_path, subs_data, subs_encoding, is_websub)
+    if cache_key is not None:
+        subtitle_cache.store(cache_key, subs_encoding, entries, source)
+    return entries
 
-def resync_subtitle(tmp_dir: str, executables: Executables, resync_sub_path: str, resync_reference_path: str,
-                    resync_reference_track: str):
-    # Support drag & drop subtitle files on some systems
-    resync_sub_path = _subtitle_path_clean(resync_sub_path)
 
-    path_ext_split = os.path.splitext(resync_sub_path)  # [path_without_extension, extension_with_dot]
+def _parse_subs(sub_path: str, subs_data: bytes, subs_encoding: str, is_websub: bool) -> list[CacheEntry]:
+    # Parse subs and generate json for frontend
+    try:
+        # Newlines are translated like for files opened in text mode
+        subs_text = subs_data.decode(subs_encoding, errors='replace')
+        subs_text = subs_text.replace('\r\n', '\n').replace('\r', '\n')
+
+        # SRT and WebVTT are parsed natively, pysubs2 handles everything else
+        entries = subtitle_parser.parse(subs_text)
+        if entries is None or (not entries and subs_text.strip()):
+            subs = pysubs2.SSAFile.from_string(subs_text)
+            subs.sort()
+            entries = [(s.plaintext.strip(), s.start, s.end) for s in subs]
+    except Exception:
+        raise SubtitleLoadError('Loading subtitle file "%s" failed.' % sub_path)
 
-    name = pathlib.Path(resync_sub_path).stem  # Get file name without extension
-    out_base_path = tmp_dir + '/' + name + '-resynced'  # Out path without index or extension
-    out_path = out_base_path + path_ext_split[1]
+    # Temporary to correct pysubs2 parsing mistakes
+    if is_websub:
+        entries = [(text.split('\n\n')[0], start, end) for text, start, end in entries]
 
-    # If the out path already exists count up until free file is found
-    try_i = 1
-    while os.path.exists(out_path):
-        out_path = out_base_path + '-' + str(try_i) + path_ext_split[1]
-        try_i += 1
+    return entries
 
-    # Run resync
-    r = subprocess.run(
-        [executables.ffsubsync, resync_reference_path, '-i', resync_sub_path, '-o', out_path, '--reftrack',
-         resync_reference_track, '--ffmpeg-path', os.path.dirname(executables.ffmpeg)])
-    if r.returncode == 0:
-        return out_path
-    return None
@@ -0,0 +1,151 @@
+import html
+import re
+
+from subtitle_cache import CacheEntry
+
+# Native parsers for SRT and WebVTT that produce cues directly, anything else goes through pysubs2. Text is cleaned
+# like pysubs2's plaintext would.
+
+# Hours are optional for WebVTT
+_TIMESTAMP_RE = re.compile(r'(?:(\d+):)?(\d{1,2}):(\d{1,2})[,.](\d{1,3})')
+# HTML-like tags of SRT/WebVTT, WebVTT timestamp tags and ASS override blocks
+_TAG_RE = re.compile(r'< */? *[a-zA-Z][^>]*>|<\d[^>]*>|\{[^}]*\}')
+# WebVTT blocks that are not cues
+_VTT_SKIPPED_BLOCKS = ('WEBVTT', 'NOTE', 'STYLE', 'REGION')
+
+
+def _timestamp_to_ms(m: re.Match) -> int:
+    h, m_, s, frac = m.groups()
+    return ((int(h or 0) * 60 + int(m_)) * 60 + int(s)) * 1000 + int(frac.ljust(3, '0'))
+
+
+def clean_text(text: str) -> str:
+    # Same result as pysubs2's plaintext
+    text = _TAG_RE.sub('', text)
+    return text.replace('\\N', '\n').replace('\\n', '\n').replace('\\h', ' ').strip()
+
+
+def _parse_timing(line: str) -> tuple[int, int] | None:
+    if '-->' not in line:
+        return None
+    start_str, _, end_str = line.partition('-->')
+    start = _TIMESTAMP_RE.search(start_str)
+    end = _TIMESTAMP_RE.search(end_str)
+    if start is None or end is None:
+        return None
+    return _timestamp_to_ms(start), _timestamp_to_ms(end)
+
+
+def _parse_block(block: str) -> CacheEntry | None:
+    lines = block.split('\n')
+    # Timing is the first line, or the second if there is a cue number
+    for i, line in enumerate(lines[:2]):
+        if '-->' in line:
+            timing = _parse_timing(line)
+            if timing is None:
+                return None
+            return clean_text('\n'.join(lines[i + 1:])), timing[0], timing[1]
+    return None
+
+
+class SrtStreamParser:
+    # Incremental SRT parser, text can be fed in arbitrary pieces and completed cues are returned as soon as the
+    # next cue started. Cues are split at timing lines like pysubs2 does, not at blank lines: a blank line can be part
+    # of the text and some files have none between cues. A number right before a timing line is the cue number.
+
+    def __init__(self):
+        self.tail = ''
+        # Timing and text lines of the cue being read, None before the first timing line
+        self.timing: tuple[int, int] | None = None
+        self.lines: list[str] = []
+
+    def feed(self, text: str) -> list[CacheEntry]:
+        data = self.tail + text
+        # A trailing \r could be the first half of \r\n
+        held = ''
+        if data.endswith('\r'):
+            data, held = data[:-1], '\r'
+        data = data.replace('\r\n', '\n').replace('\r', '\n')
+
+        i = data.rfind('\n')
+        if i < 0:
+            self.tail = data + held
+            return []
+        self.tail = data[i + 1:] + held
+        return self._parse_lines(data[:i].split('\n'))
+
+    def close(self) -> list[CacheEntry]:
+        data = self.tail.replace('\r', '\n')
+        self.tail = ''
+        cues = self._parse_lines(data.split('\n'))
+        cue = self._finish_cue()
+        if cue is not None:
+            cues.append(cue)
+        return cues
+
+    def _parse_lines(self, lines: list[str]) -> list[CacheEntry]:
+        cues = []
+        for line in lines:
+            timing = _parse_timing(line)
+            if timing is None:
+                self.lines.append(line.strip('\ufeff'))
+                continue
+            cue = self._finish_cue()
+            if cue is not None:
+                cues.append(cue)
+            self.timing = timing
+        return cues
+
+    def _finish_cue(self) -> CacheEntry | None:
+        lines = self.lines
+        self.lines = []
+        # Drop the number of the next cue and the blank lines around it
+        while lines and not lines[-1].strip():
+            lines.pop()
+        if lines and lines[-1].strip().isdigit():
+            lines.pop()
+        if self.timing is None:
+            return None
+        return clean_text('\n'.join(lines)), self.timing[0], self.timing[1]
+
+
+def parse_srt(text: str) -> list[CacheEntry]:
+    parser = SrtStreamParser()
+    return parser.feed(text) + parser.close()
+
+
+def parse_vtt(text: str) -> list[CacheEntry]:
+    cues = []
+    for block in text.replace('\r\n', '\n').replace('\r', '\n').split('\n\n'):
+        block = block.strip('\n\ufeff')
+        if not block or block.startswith(_VTT_SKIPPED_BLOCKS):
+            continue
+        cue = _parse_block(block)
+        if cue is not None:
+            cues.append((html.unescape(cue[0]), cue[1], cue[2]))
+    return cues
+
+
+def guess_format(text: str) -> str | None:
+    # 'srt', 'vtt' or None if the native parsers don't handle it
+    head = text[:4096].lstrip('\ufeff \t\r\n')
+    if head.startswith('WEBVTT'):
+        return 'vtt'
+    # SRT starts with a cue, the timing is on the first line or follows the cue number
+    lines = head.replace('\r\n', '\n').replace('\r', '\n').split('\n', 2)
+    if '-->' in lines[0] or (len(lines) > 1 and lines[0].strip().isdigit() and '-->' in lines[1]):
+        return 'srt'
+    return None
+
+
+def parse(text: str) -> list[CacheEntry] | None:
+    # Returns the cues sorted by time, None if the format is not supported natively
+    subs_format = guess_format(text)
+    if subs_format == 'srt':
+        cues = parse_srt(text)
+    elif subs_format == 'vtt':
+        cues = parse_vtt(text)
+    else:
+        return None
+    cues.sort(key=lambda c: (c[1], c[2]))
+    return cues
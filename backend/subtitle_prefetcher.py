@@ -0,0 +1,110 @@
+import pathlib
+import re
+import subprocess
+import threading
+
+from config import Config
+from executables import Executables
+from subtitle_cache import SubtitleCache
+from subtitle_extractor import SubtitleExtractor, SUPPORTED_CODECS, set_process_priority
+from subtitle_manager import read_subs_file, SubtitleLoadError
+from utils.disk_cache import DiskCache
+
+# Subtitle files next to a media file that mpv loads along with it
+SUBTITLE_EXTENSIONS = {'.srt', '.vtt', '.ass', '.ssa'}
+
+# Subtitle streams as ffmpeg -i prints them, e.g. '  Stream #0:2[0x1100](jpn): Subtitle: subrip (default)'
+SUBTITLE_STREAM_RE = re.compile(r'^\s*Stream #\d+:(\d+)(?:\[\w+\])?(?:\(\w+\))?: Subtitle: (\w+)', re.MULTILINE)
+
+
+def probe_subtitle_streams(ffmpeg: str, media_path: str, timeout: float = 30.0) -> list[tuple[str, str]]:
+    # (ff-index, codec) of the subtitle streams in the file, probed at low priority like the export
+    try:
+        process = subprocess.Popen([ffmpeg, '-hide_banner', '-i', media_path], stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError:
+        return []
+    set_process_priority(process, True)
+    try:
+        _, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        return []
+    # Without an output file ffmpeg exits with an error after printing the input info
+    return SUBTITLE_STREAM_RE.findall(stderr.decode('utf-8', errors='replace'))
+
+
+class SubtitlePrefetcher:
+    # Prepares the subtitles of the next files in the playlist while the current one plays. Internal tracks are
+    # exported into the extraction cache at idle priority, those and the subtitle files next to the media are parsed
+    # into the subtitle cache. Opening Migaku for one of these files then only reads from the caches.
+
+    def __init__(self, tmp_dir: str, executables: Executables, config: Config,
+                 subtitle_cache: SubtitleCache | None = None, extraction_cache: DiskCache | None = None):
+        self.executables = executables
+        self.subtitle_cache = subtitle_cache
+        self.extraction_cache = extraction_cache
+        # Separate from the extractor of the current file, so neither cancels the other
+        self.extractor = SubtitleExtractor(tmp_dir, executables, config, extraction_cache)
+        self.lock = threading.Lock()
+        self.queue: list[str] = []
+        self.thread: threading.Thread | None = None
+
+    def prefetch(self, media_paths: list[str]):
+        # Replaces what is left of the previous list, the file being worked on is finished
+        with self.lock:
+            self.queue = [path for path in media_paths if '://' not in path]
+            if self.queue and self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='SubtitlePrefetcher', daemon=True)
+                self.thread.start()
+
+    def cancel(self):
+        with self.lock:
+            self.queue = []
+        self.extractor.cancel()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.thread = None
+                    return
+                media_path = self.queue.pop(0)
+            try:
+                self._prefetch_file(media_path)
+            except Exception as e:
+                print('PREF: Prefetching subtitles of %s failed: %s' % (media_path, e))
+
+    def _prefetch_file(self, media_path: str):
+        print('PREF: Prefetching subtitles of', media_path)
+
+        # (path, source) of the subtitle files to parse
+        sub_files = [(path, path) for path in self._subtitle_files_next_to(media_path)]
+
+        if self.executables.ffmpeg and self.extraction_cache is not None:
+            streams = probe_subtitle_streams(self.executables.ffmpeg, media_path)
+            tracks = [(track, sub_codec) for track, sub_codec in streams if sub_codec in SUPPORTED_CODECS]
+            if tracks:
+                self.extractor.start(media_path, ['%s*%s' % track_info for track_info in tracks])
+                for track, sub_codec in tracks:
+                    path = self.extractor.wait_for(media_path, track, sub_codec, raise_priority=False)
+                    if path is not None:
+                        sub_files.append((path, '%s (track %s)' % (media_path, track)))
+
+        if self.subtitle_cache is None:
+            return
+        for path, source in sub_files:
+            try:
+                read_subs_file(path, self.subtitle_cache, source=source)
+            except SubtitleLoadError as e:
+                print('PREF:', e)
+
+    @staticmethod
+    def _subtitle_files_next_to(media_path: str) -> list[str]:
+        media = pathlib.Path(media_path)
+        try:
+            return [str(path) for path in media.parent.iterdir()
+                    if path.name.startswith(media.stem) and path.suffix.lower() in SUBTITLE_EXTENSIONS]
+        except OSError:
+            return []
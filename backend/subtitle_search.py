@@ -0,0 +1,143 @@
+import bisect
+import concurrent.futures
+import threading
+import unicodedata
+from array import array
+
+from subtitle_cache import SubtitleCache, CacheEntry
+
+
+def normalize(text: str) -> str:
+    # Matching ignores case, full/half width forms and how lines are broken
+    return ' '.join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+class SubtitleIndex:
+    # Inverted index of character bigrams, it needs no word segmentation so Japanese and Chinese work like everything
+    # else. The cues containing all bigrams of a query are candidates, those are checked with a substring search.
+
+    def __init__(self, texts: list[str]):
+        self.texts = [normalize(text) for text in texts]
+        # Bigram -> sorted indices of the cues containing it
+        self.postings: dict[str, array] = {}
+        for i, text in enumerate(self.texts):
+            for gram in {text[j:j + 2] for j in range(len(text) - 1)}:
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array('I')
+                posting.append(i)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def search(self, query: str, limit: int | None = None) -> list[int]:
+        # Indices of the matching cues in order
+        query = normalize(query)
+        if not query:
+            return []
+
+        if len(query) < 2:
+            candidates = range(len(self.texts))
+        else:
+            postings = []
+            for gram in {query[j:j + 2] for j in range(len(query) - 1)}:
+                posting = self.postings.get(gram)
+                if posting is None:
+                    return []
+                postings.append(posting)
+            # Start with the rarest bigram, the others are only probed for its cues
+            postings.sort(key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                candidates = [i for i in candidates if self._contains(posting, i)]
+                if not candidates:
+                    return []
+
+        results = []
+        for i in candidates:
+            if query in self.texts[i]:
+                results.append(i)
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
+
+    @staticmethod
+    def _contains(posting: array, i: int) -> bool:
+        j = bisect.bisect_left(posting, i)
+        return j < len(posting) and posting[j] == i
+
+
+class CachedTracksIndex:
+    # Index of every track in the subtitle cache, one SubtitleIndex per cache entry. Searching the cache is opt-in, so
+    # nothing is loaded until the first search. That starts indexing the cached tracks in the background, until it is
+    # done searches only see part of them. From then on entries are indexed on a background thread when they are
+    # stored and dropped when they are removed, searching never touches the disk.
+
+    def __init__(self, subtitle_cache: SubtitleCache):
+        self.subtitle_cache = subtitle_cache
+        self.lock = threading.Lock()
+        # Cache key -> (source, entries, index)
+        self.tracks: dict[str, tuple[str, list[CacheEntry], SubtitleIndex]] = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, 'CachedTracksIndex')
+        self.closed = False
+        # Whether indexing the cache started, stores before that are picked up by it
+        self.started = False
+        subtitle_cache.set_listener(self._on_store, self._on_remove)
+
+    def search(self, query: str, limit: int | None = None) -> list[tuple[str, int, int, str]]:
+        # (source, start, end, text) of the matching cues
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self._submit(self._index_cached)
+            tracks = list(self.tracks.values())
+
+        results = []
+        for source, entries, index in tracks:
+            for i in index.search(query, None if limit is None else limit - len(results)):
+                text, start, end = entries[i]
+                results.append((source, start, end, text))
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def close(self):
+        # Indexing that did not start yet is dropped
+        self.closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, *args):
+        try:
+            self.executor.submit(*args)
+        except RuntimeError:
+            # Closed already
+            pass
+
+    def _on_store(self, key: str, entries: list[CacheEntry], source: str):
+        with self.lock:
+            if not self.started:
+                return
+        self._submit(self._add, key, source, entries)
+
+    def _on_remove(self, key: str):
+        with self.lock:
+            self.tracks.pop(key, None)
+
+    def _add(self, key: str, source: str, entries: list[CacheEntry]):
+        index = SubtitleIndex([text for text, _, _ in entries])
+        with self.lock:
+            # Evicted again while it was being indexed?
+            if self.subtitle_cache.contains(key):
+                self.tracks[key] = (source, entries, index)
+
+    def _index_cached(self):
+        count = 0
+        for key, source, entries in self.subtitle_cache.all_tracks():
+            if self.closed:
+                return
+            with self.lock:
+                if key in self.tracks:
+                    continue
+            self._add(key, source, entries)
+            count += len(entries)
+        print('SUBS: Indexed %d cached cues' % count)
@@ -0,0 +1,81 @@
+import bisect
+import itertools
+import json
+from array import array
+from typing import Iterable
+
+from subtitle_cache import CacheEntry
+
+
+class SubtitleTrack:
+    # Subtitles stored as columns, sorted by start: times as int64 arrays and all texts in one string with offsets.
+    # Cues are addressed by their index, which is also their id in the frontend.
+    #
+    # Subs can overlap each other, so the ends are not sorted. The running maximum of the ends is, and together with
+    # the starts it gives the range of cues that may overlap a time span with two binary searches.
+
+    def __init__(self, entries: Iterable[CacheEntry] = ()):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.text_offsets = array('q', [0])
+        texts = []
+        offset = 0
+        for text, start, end in entries:
+            self.starts.append(start)
+            self.ends.append(end)
+            texts.append(text)
+            offset += len(text)
+            self.text_offsets.append(offset)
+        self.text_buffer = ''.join(texts)
+        self.max_ends = array('q', itertools.accumulate(self.ends, max))
+
+        # [first, last) indices of the secondary cues each cue may overlap, see link_secondary()
+        self.secondary_firsts = array('q', bytes(8 * len(self.starts)))
+        self.secondary_lasts = array('q', bytes(8 * len(self.starts)))
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[CacheEntry], skip_empty: bool = False) -> 'SubtitleTrack':
+        # Rounds the times to 10ms like mpv does and drops empty cues if requested
+        return cls((text, max(start, 0) // 10 * 10, max(end, 0) // 10 * 10)
+                   for text, start, end in entries if not skip_empty or text.strip())
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def text(self, i: int) -> str:
+        return self.text_buffer[self.text_offsets[i]:self.text_offsets[i + 1]]
+
+    def texts(self) -> list[str]:
+        buffer = self.text_buffer
+        offsets = self.text_offsets
+        return [buffer[offsets[i]:offsets[i + 1]] for i in range(len(self.starts))]
+
+    def range(self, start: int, end: int) -> tuple[int, int]:
+        # [first, last) indices of the cues that may overlap the span, can contain cues that end before it
+        first = bisect.bisect_left(self.max_ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        return first, max(first, last)
+
+    def overlapping(self, start: int, end: int, candidates: tuple[int, int] | None = None) -> list[int]:
+        first, last = candidates if candidates is not None else self.range(start, end)
+        return [i for i in range(first, last) if not (self.ends[i] < start or self.starts[i] > end)]
+
+    def link_secondary(self, secondary: 'SubtitleTrack'):
+        for i in range(len(self.starts)):
+            self.secondary_firsts[i], self.secondary_lasts[i] = secondary.range(self.starts[i], self.ends[i])
+
+    def translation(self, ids: list[int], secondary: 'SubtitleTrack') -> str:
+        # Text of the secondary cues overlapping the span of the given cues, requires link_secondary()
+        start = min(self.starts[i] for i in ids)
+        end = max(self.ends[i] for i in ids)
+        candidates = (min(self.secondary_firsts[i] for i in ids), max(self.secondary_lasts[i] for i in ids))
+        return ' '.join(secondary.text(i) for i in secondary.overlapping(start, end, candidates))
+
+    def to_json(self, version: int) -> bytes:
+        # Columnar wire format for the frontend, ids are the indices and only valid for the given state version
+        return json.dumps({
+            'version': version,
+            'start': self.starts.tolist(),
+            'end': self.ends.tolist(),
+            'text': self.texts(),
+        }, ensure_ascii=False, separators=(',', ':')).encode()
@@ -0,0 +1,37 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from queue_handler import QueueHandler
+
+
+class QueueHandlerTest(unittest.TestCase):
+
+    def test_resume_before_first_event(self):
+        queue_handler = QueueHandler()
+        client = queue_handler.add_client()
+        event_id = queue_handler.initial_event_id(client)
+
+        # Dropped before it received anything
+        queue_handler.send_data('r', client)
+        queue_handler.remove_client(client)
+
+        resumed = queue_handler.add_client(event_id)
+        self.assertEqual(resumed.client_id, client.client_id)
+        self.assertEqual([data for _, data in queue_handler.read(resumed)], ['r'])
+
+    def test_new_client_skips_targeted_events(self):
+        queue_handler = QueueHandler()
+        client = queue_handler.add_client()
+        queue_handler.send_data('r', client)
+        queue_handler.remove_client(client)
+
+        other = queue_handler.add_client()
+        self.assertNotEqual(other.client_id, client.client_id)
+        self.assertEqual(queue_handler.read(other), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import subtitle_parser
+
+# Cues without blank lines between them
+SRT_WITHOUT_BLANK_LINES = '1\n00:00:01,000 --> 00:00:02,000\nA\n2\n00:00:03,000 --> 00:00:04,000\nB'
+# Blank line inside the text of the first cue
+SRT_WITH_PARAGRAPHS = '1\n00:00:01,000 --> 00:00:02,000\nline a\n\nline b\n\n2\n00:00:03,000 --> 00:00:04,000\nc\n'
+SRT_CRLF = '\ufeff1\r\n00:00:01,000 --> 00:00:02,000\r\n<i>A</i>\r\n\r\n2\r\n00:00:03,000 --> 00:00:04,000\r\nB\r\n\r\n'
+
+
+def parse_streamed(text, piece_size):
+    parser = subtitle_parser.SrtStreamParser()
+    cues = []
+    for i in range(0, len(text), piece_size):
+        cues += parser.feed(text[i:i + piece_size])
+    return cues + parser.close()
+
+
+class SrtParserTest(unittest.TestCase):
+
+    def test_cues_without_blank_lines(self):
+        expected = [('A', 1000, 2000), ('B', 3000, 4000)]
+        self.assertEqual(subtitle_parser.parse(SRT_WITHOUT_BLANK_LINES), expected)
+        for piece_size in [1, 7, len(SRT_WITHOUT_BLANK_LINES)]:
+            self.assertEqual(parse_streamed(SRT_WITHOUT_BLANK_LINES, piece_size), expected)
+
+    def test_blank_line_inside_cue(self):
+        expected = [('line a\n\nline b', 1000, 2000), ('c', 3000, 4000)]
+        self.assertEqual(subtitle_parser.parse(SRT_WITH_PARAGRAPHS), expected)
+        for piece_size in [1, 7, len(SRT_WITH_PARAGRAPHS)]:
+            self.assertEqual(parse_streamed(SRT_WITH_PARAGRAPHS, piece_size), expected)
+
+    def test_crlf(self):
+        self.assertEqual(subtitle_parser.guess_format(SRT_CRLF), 'srt')
+        expected = [('A', 1000, 2000), ('B', 3000, 4000)]
+        self.assertEqual(subtitle_parser.parse(SRT_CRLF), expected)
+        for piece_size in [1, 7, len(SRT_CRLF)]:
+            self.assertEqual(parse_streamed(SRT_CRLF, piece_size), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+import time
+from typing import Callable
+
+
+class DiskCache:
+    # Directory of files addressed by key with LRU eviction by total size. The modification time of an entry is
+    # bumped on every hit and serves as its last use time, so the cache survives restarts without an index file.
+
+    def __init__(self, cache_dir: str, max_size: int, extension: str = ''):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.extension = extension
+        self.lock = threading.Lock()
+        # Called with the key of every entry removed by remove() or evict()
+        self.on_remove: Callable[[str], None] | None = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = str(part).encode('utf-8')
+            h.update(len(part).to_bytes(8, 'little'))
+            h.update(part)
+        return h.hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + self.extension)
+
+    def key_for_path(self, path: str) -> str:
+        name = os.path.basename(path)
+        return name[:len(name) - len(self.extension)]
+
+    def get(self, key: str) -> str | None:
+        # Returns the path of the entry if cached
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get_bytes(self, key: str) -> bytes | None:
+        path = self.get(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put_bytes(self, key: str, data: bytes) -> str:
+        tmp_path = self.path_for(key) + '.%d.tmp' % threading.get_ident()
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return self.put_file(key, tmp_path)
+
+    def put_file(self, key: str, src_path: str) -> str:
+        # Moves the file into the cache, replacing an existing entry atomically
+        path = self.path_for(key)
+        os.replace(src_path, path)
+        self.evict()
+        return path
+
+    def remove(self, key: str):
+        try:
+            os.remove(self.path_for(key))
+        except OSError:
+            return
+        self._removed(key)
+
+    def _removed(self, key: str):
+        if self.on_remove is not None:
+            self.on_remove(key)
+
+    def entries(self) -> list[tuple[str, int, float]]:
+        # (path, size, last use) of all entries
+        ret = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.is_file() or not entry.name.endswith(self.extension) or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                ret.append((entry.path, st.st_size, st.st_mtime))
+        return ret
+
+    def evict(self):
+        with self.lock:
+            entries = self.entries()
+            total_size = sum(size for _, size, _ in entries)
+            if total_size <= self.max_size:
+                return
+
+            # Least recently used first
+            entries.sort(key=lambda e: e[2])
+            for path, size, _ in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                    total_size -= size
+                except OSError:
+                    continue
+                self._removed(self.key_for_path(path))
+
+    def remove_stale_tmp_files(self, max_age: float = 3600.0):
+        # Leftovers of writes interrupted by a crash
+        now = time.time()
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    try:
+                        if now - entry.stat(follow_symlinks=False).st_mtime > max_age:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass
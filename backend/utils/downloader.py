@@ -0,0 +1,144 @@
+import email.utils
+import json
+import os
+import threading
+import time
+
+import requests
+
+from utils.disk_cache import DiskCache
+
+
+class Downloader:
+    # Downloads files over a shared session and keeps them in an optional disk cache. Cached files are revalidated
+    # with ETag/Last-Modified and not requested at all while Cache-Control max-age says they are fresh. If the server
+    # can't be reached, the cached file is used as is.
+
+    # (connect, read) timeouts in seconds
+    TIMEOUT = (10.0, 30.0)
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, cache: DiskCache | None = None):
+        self.cache = cache
+        self.session = requests.Session()
+        if cache is not None:
+            self._remove_orphaned_metadata()
+
+    def close(self):
+        self.session.close()
+
+    def download(self, url: str, tmp_path: str) -> str:
+        # Returns the path of the downloaded file, that is tmp_path if there is no cache
+        if self.cache is None:
+            self._fetch(url, {}, tmp_path)
+            return tmp_path
+
+        key = DiskCache.make_key(url)
+        cached_path = self.cache.get(key)
+        metadata = self._load_metadata(key) if cached_path is not None else None
+
+        headers = {}
+        if metadata is not None:
+            if metadata.get('expires', 0) > time.time():
+                print('DL: Fresh in cache:', url)
+                return cached_path
+            if metadata.get('etag'):
+                headers['If-None-Match'] = metadata['etag']
+            if metadata.get('last_modified'):
+                headers['If-Modified-Since'] = metadata['last_modified']
+
+        download_path = self.cache.path_for(key) + '.%d.tmp' % threading.get_ident()
+        try:
+            response = self._fetch(url, headers, download_path)
+        except requests.RequestException as e:
+            if cached_path is None:
+                raise
+            print('DL: Request failed, using cached file:', e)
+            return cached_path
+
+        if response.status_code == 304:
+            print('DL: Not modified:', url)
+            self._save_metadata(key, response, metadata)
+            return cached_path
+
+        path = self.cache.put_file(key, download_path)
+        self._save_metadata(key, response)
+        return path
+
+    def _fetch(self, url: str, headers: dict, path: str) -> requests.Response:
+        # Streams the body to path unless the server answers 304
+        with self.session.get(url, headers=headers, timeout=self.TIMEOUT, stream=True) as response:
+            if response.status_code == 304:
+                return response
+            response.raise_for_status()
+            try:
+                with open(path, 'wb') as f:
+                    for chunk in response.iter_content(self.CHUNK_SIZE):
+                        f.write(chunk)
+            except BaseException:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                raise
+            print('DL: Downloaded %s (%d bytes)' % (url, os.path.getsize(path)))
+            return response
+
+    def _metadata_path(self, key: str) -> str:
+        return os.path.join(self.cache.cache_dir, key + '.json')
+
+    def _load_metadata(self, key: str) -> dict | None:
+        try:
+            with open(self._metadata_path(key), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_metadata(self, key: str, response: requests.Response, previous: dict | None = None):
+        # A 304 may leave out validators, the previous ones stay valid then
+        metadata = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'expires': self._expires(response),
+        }
+        if previous is not None:
+            for name in ['etag', 'last_modified']:
+                if metadata[name] is None:
+                    metadata[name] = previous.get(name)
+        try:
+            with open(self._metadata_path(key), 'w', encoding='utf-8') as f:
+                json.dump(metadata, f)
+        except OSError as e:
+            print('DL: Writing cache metadata failed:', e)
+
+    @staticmethod
+    def _expires(response: requests.Response) -> float:
+        # Time until which the response may be used without asking the server, 0 if it has to be revalidated
+        cache_control = [d.strip().lower() for d in response.headers.get('Cache-Control', '').split(',')]
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+        for directive in cache_control:
+            if directive.startswith('max-age='):
+                try:
+                    return time.time() + int(directive[8:]) - int(response.headers.get('Age', 0))
+                except ValueError:
+                    return 0
+        expires = response.headers.get('Expires')
+        if expires:
+            try:
+                return email.utils.parsedate_to_datetime(expires).timestamp()
+            except (TypeError, ValueError):
+                return 0
+        return 0
+
+    def _remove_orphaned_metadata(self):
+        # Metadata of files the cache evicted
+        with os.scandir(self.cache.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    key = entry.name[:-len('.json')]
+                    if not os.path.isfile(self.cache.path_for(key)):
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
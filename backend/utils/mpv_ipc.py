@@ -1,42 +1,105 @@
-import socket
+import asyncio
 import os
 import json
-import time
 import threading
 
 
-class MpvIpc_Base():
+class MpvError(Exception):
+    pass
 
-    def __init__(self, ipc_handle_path):
-        self.port_open(ipc_handle_path)
+
+class JsonLineFramer():
+
+    # Splits the IPC byte stream into lines. All complete lines are returned as soon as they arrived, only the
+    # trailing partial line stays buffered and already scanned data is never scanned again.
+
+    MAX_LINE_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.discarding = False
+
+    def feed(self, data):
+        self.buffer += data
+
+        end = self.buffer.rfind(b'\n', self.scan_pos)
+        if end < 0:
+            self.scan_pos = len(self.buffer)
+            # Don't let a line without end grow the buffer forever, skip it up to the next newline instead
+            if len(self.buffer) > self.MAX_LINE_LENGTH:
+                print('IPC: Dropping line longer than', self.MAX_LINE_LENGTH, 'bytes')
+                self.buffer = bytearray()
+                self.scan_pos = 0
+                self.discarding = True
+            return []
+
+        # Decode and split all complete lines at once
+        text = self.buffer[:end].decode('utf-8', errors='ignore')
+        del self.buffer[:end + 1]
+        self.scan_pos = 0
+
+        lines = text.split('\n')
+        if self.discarding:
+            lines.pop(0)
+            self.discarding = False
+        return [line for line in lines if line]
+
+
+class MpvIpcAsync():
+
+    # Connection to the mpv IPC on an asyncio loop. Sending (send_json, command, show_text, ...) works from any
+    # thread. request(), batch() and the property getters must be used on the loop, they return asyncio
+    # futures that resolve while listen() is being iterated.
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.loop = None
+        self.loop_thread = None
+        self.reader = None
+        self.writer = None
+        self.requests = {}
+        self.next_request_id = 1
+
+    async def open(self, ipc_handle_path):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.reader, self.writer = await self.port_open(ipc_handle_path)
 
     def close(self):
-        self.port_close()
+        if self.writer is not None:
+            self.writer.close()
 
-    # Starts a loop that yields received json data
-    # Exits when mpv closes the pipe or any errors occur
-    def listen(self):
-        data = b''
+    # Yields received json data, exits when mpv closes the pipe or any errors occur
+    async def listen(self):
+        framer = JsonLineFramer()
         try:
             while True:
-                new_data = self.port_read(1024)
+                new_data = await self.reader.read(self.READ_SIZE)
                 if new_data == b'':
                     break
-                data += new_data
-                if data[-1] != 10:
-                    continue       
-                utf8_data = data.decode('utf-8', errors='ignore')
-                for line in utf8_data.split('\n'):
-                    if line != '':
+                for line in framer.feed(new_data):
+                    try:
                         loaded_data = json.loads(line)
-                        yield loaded_data
-                data = b''
+                    except ValueError:
+                        print('IPC: Invalid json:', line[:200])
+                        continue
+                    if 'request_id' in loaded_data and self.resolve_request(loaded_data):
+                        continue
+                    yield loaded_data
 
         except (OSError, BrokenPipeError, EOFError):
             pass
 
+        self.fail_requests(EOFError('mpv IPC connection closed'))
+
     def send_json_txt(self, data):
-        self.port_send(data.encode('utf-8') + b'\n')
+        line = data.encode('utf-8') + b'\n'
+        if threading.current_thread() is self.loop_thread:
+            self.writer.write(line)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, line)
 
     def send_json(self, data):
         self.send_json_txt(json.dumps(data))
@@ -49,74 +112,91 @@ class MpvIpc_Base():
         millis = int(duration * 1000)
         self.command('show-text', text, millis)
 
-    # Plattform specific
-
-    def port_open(self, ipc_handle_path):
-        raise NotImplementedError
-
-    def port_close(self):
-        raise NotImplementedError
-
-    def port_send(self, data):
-        raise NotImplementedError
-
-    def port_read(self, readlen):
-        return self.socket.recv(readlen)
-
-
-class MpvIpc_Unix(MpvIpc_Base):
-    
-    def port_open(self, ipc_handle_path):
-        self.socket = socket.socket(socket.AF_UNIX)
-        self.socket.connect(ipc_handle_path)
-
-    def port_close(self):
-        try:
-            self.socket.shutdown(socket.SHUT_WR)
-            self.socket.close()
-        except:
-            pass
-
-    def port_send(self, data):
-        self.socket.send(data)
-
-    def port_read(self, readlen):
-        return self.socket.recv(readlen)
-
+    def request_json(self, data):
+        return self.batch_json([data])[0]
+
+    def request(self, command, *args):
+        return self.batch([[command] + list(args)])[0]
+
+    def batch(self, commands):
+        futures = []
+        for reply_future in self.batch_json([{'command': command} for command in commands]):
+            future = self.loop.create_future()
+            reply_future.add_done_callback(lambda f, future=future: self._unwrap_reply(f, future))
+            futures.append(future)
+        return futures
+
+    def batch_json(self, datas):
+        futures = []
+        lines = []
+        for data in datas:
+            future = self.loop.create_future()
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            self.requests[request_id] = future
+            futures.append(future)
+            lines.append(json.dumps(dict(data, request_id=request_id)))
+        self.send_json_txt('\n'.join(lines))
+        return futures
+
+    async def get_property(self, name, timeout=2.0):
+        return await asyncio.wait_for(self.request('get_property', name), timeout)
+
+    async def get_properties(self, names, timeout=2.0):
+        futures = self.batch([['get_property', name] for name in names])
+        results = await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), timeout)
+        return {name: (None if isinstance(result, Exception) else result) for name, result in zip(names, results)}
+
+    def resolve_request(self, data):
+        future = self.requests.pop(data['request_id'], None)
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(data)
+        return True
+
+    def fail_requests(self, exc):
+        futures = list(self.requests.values())
+        self.requests.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+
+    @staticmethod
+    def _unwrap_reply(reply_future, future):
+        if future.done():
+            return
+        if reply_future.cancelled():
+            future.cancel()
+            return
+        exc = reply_future.exception()
+        if exc is not None:
+            future.set_exception(exc)
+            return
+        reply = reply_future.result()
+        if reply.get('error', 'success') != 'success':
+            future.set_exception(MpvError(reply['error']))
+        else:
+            future.set_result(reply.get('data'))
 
-class MpvIpc_Windows(MpvIpc_Base):
+    # Plattform specific
 
-    def port_open(self, ipc_handle_path):
-        import _winapi
-        from multiprocessing.connection import PipeConnection
+    async def port_open(self, ipc_handle_path):
+        if os.name != 'nt':
+            return await asyncio.open_unix_connection(ipc_handle_path, limit=self.READ_SIZE)
 
+        # Named pipes need the proactor loop, which is the default on Windows
         ipc_handle_path = "\\\\.\\pipe\\" + ipc_handle_path
-
+        reader = asyncio.StreamReader(limit=self.READ_SIZE)
+        protocol = asyncio.StreamReaderProtocol(reader)
         for _ in range(10):
             try:
-                pipe_handle = _winapi.CreateFile(
-                    ipc_handle_path, _winapi.GENERIC_READ | _winapi.GENERIC_WRITE,
-                    0, _winapi.NULL, _winapi.OPEN_EXISTING, _winapi.FILE_FLAG_OVERLAPPED, _winapi.NULL
-                )
+                transport, _ = await self.loop.create_pipe_connection(lambda: protocol, ipc_handle_path)
                 break
             except OSError:
-                time.sleep(0.2)
+                await asyncio.sleep(0.2)
         else:
             raise OSError('Opening pipe failed')
+        writer = asyncio.StreamWriter(transport, protocol, reader, self.loop)
+        return reader, writer
 
-        self.socket = PipeConnection(pipe_handle)
-
-    def port_close(self):
-        self.socket.close()
-
-    def port_send(self, data):
-        self.socket.send_bytes(data)
-
-    def port_read(self, readlen):
-        return self.socket.recv_bytes(readlen)
-
-
-if os.name == 'nt':
-    MpvIpc = MpvIpc_Windows
-else:
-    MpvIpc = MpvIpc_Unix
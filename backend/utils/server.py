@@ -1,6 +1,20 @@
-import socket
+import asyncio
+import base64
+import collections
+import concurrent.futures
 import errno
+import gzip
+import hashlib
+import mimetypes
+import os
+import socket
 import threading
+import urllib.parse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 
@@ -42,6 +56,7 @@ class HttpResponse():
         415: 'Unsupported Media Type',
         416: 'Requested range not satisfiable',
         417: 'Expectation Failed',
+        431: 'Request Header Fields Too Large',
         500: 'Internal Server Error',
         501: 'Not Implemented',
         502: 'Bad Gateway',
@@ -51,7 +66,7 @@ class HttpResponse():
     }
 
 
-    def __init__(self, code=200, content=None, content_type=None, headers={}):
+    def __init__(self, code=200, content=None, content_type=None, headers={}, stream=False):
 
         self.code = code
         if code not in self.STATUS_FOR_CODE:
@@ -60,6 +75,8 @@ class HttpResponse():
         self.content = content
         self.content_type = content_type
         self.headers = headers
+        # Streamed responses have no length, they end when the connection closes
+        self.stream = stream
 
 
     def header_text(self):
@@ -67,8 +84,9 @@ class HttpResponse():
 
         ret.append('HTTP/1.1 %d %s' % (self.code, self.STATUS_FOR_CODE[self.code]))
     
-        if self.content:
-            ret.append('Content-Length: ' + str(len(self.content)))
+        # Always send a length so the connection can be reused for the next request
+        if not self.stream and self.code >= 200 and self.code not in [204, 304]:
+            ret.append('Content-Length: ' + str(len(self.content or b'')))
         if self.content_type:
             ret.append('Content-Type: ' + self.content_type)
 
@@ -86,9 +104,649 @@ class HttpResponse():
 
 
 
+class HttpContent():
+
+    # Immutable response body with a precomputed ETag and compressed variants, so serving it again only costs a
+    # header lookup and a copy.
+
+    COMPRESS_MIN_SIZE = 512
+
+    def __init__(self, content, content_type, encodings=('br', 'gzip')):
+
+        self.content = content
+        self.content_type = content_type
+        self.etag = '"' + hashlib.sha1(content).hexdigest()[:24] + '"'
+
+        # Content-Encoding -> body, in order of preference
+        self.encoded = {}
+        if len(content) >= self.COMPRESS_MIN_SIZE:
+            if 'br' in encodings and brotli is not None:
+                self.add_encoded('br', brotli.compress(content, quality=11))
+            if 'gzip' in encodings:
+                self.add_encoded('gzip', gzip.compress(content, compresslevel=9, mtime=0))
+
+
+    def add_encoded(self, encoding, encoded_content):
+
+        if len(encoded_content) < len(self.content):
+            self.encoded[encoding] = encoded_content
+
+
+    def variant_etag(self, encoding):
+
+        if encoding is None:
+            return self.etag
+        return self.etag[:-1] + '-' + encoding + '"'
+
+
+    def matches(self, if_none_match):
+
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == '*' or tag == self.etag or (tag.startswith(self.etag[:-1] + '-')):
+                return True
+        return False
+
+
+    def accepted_encoding(self, accept_encoding):
+
+        if not accept_encoding or not self.encoded:
+            return None
+
+        accepted = set()
+        for item in accept_encoding.split(','):
+            name, _, params = item.strip().partition(';')
+            params = params.replace(' ', '')
+            if params.startswith('q=') and params[2:] in ['0', '0.0', '0.00', '0.000']:
+                continue
+            accepted.add(name.strip().lower())
+
+        for encoding in self.encoded:
+            if encoding in accepted or '*' in accepted:
+                return encoding
+        return None
+
+
+    def response(self, request, headers={}):
+
+        encoding = self.accepted_encoding(request.header('Accept-Encoding')) if request else None
+
+        response_headers = {
+            'ETag': self.variant_etag(encoding),
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+        }
+        response_headers.update(headers)
+
+        if request and self.matches(request.header('If-None-Match')):
+            return HttpResponse(304, headers=response_headers)
+
+        if encoding is None:
+            return HttpResponse(content=self.content, content_type=self.content_type, headers=response_headers)
+
+        response_headers['Content-Encoding'] = encoding
+        return HttpResponse(content=self.encoded[encoding], content_type=self.content_type, headers=response_headers)
+
+
+
+class HttpStaticFile():
+
+    # File kept in memory as HttpContent, reloaded when its modification time or size changes on disk
+
+    def __init__(self, path):
+
+        self.path = path
+        self.stat_key = None
+        self.content = None
+        self.lock = threading.Lock()
+
+        content_type, _ = mimetypes.guess_type(path)
+        if content_type is None:
+            content_type = 'application/octet-stream'
+        elif content_type.startswith('text/') or content_type in ['application/javascript', 'application/json']:
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+
+
+    def current_stat_key(self):
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+
+    def is_fresh(self):
+
+        return self.content is not None and self.stat_key == self.current_stat_key()
+
+
+    def get(self):
+
+        with self.lock:
+            stat_key = self.current_stat_key()
+            if stat_key is None:
+                return None
+            if self.content is None or stat_key != self.stat_key:
+                with open(self.path, 'rb') as f:
+                    self.content = HttpContent(f.read(), self.content_type)
+                self.stat_key = stat_key
+                print('HTTP: Loaded', self.path, {e: len(c) for e, c in self.content.encoded.items()})
+            return self.content
+
+
+
+class HttpRequest():
+
+    def __init__(self, method, uri, version, headers):
+
+        self.method = method
+        self.uri = uri
+        self.version = version
+        # Header names are lower case
+        self.headers = headers
+        self.body = b''
+
+        self.path, _, query = uri.partition('?')
+        self.query = {k: v[-1] for k, v in urllib.parse.parse_qs(query).items()}
+
+
+    def header(self, name, default=None):
+
+        return self.headers.get(name.lower(), default)
+
+
+    def keep_alive(self):
+
+        connection = self.header('Connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+
+class HttpRequestParser():
+
+    # Incremental HTTP/1.1 request parser. Data is fed as it arrives and complete requests are returned as soon as
+    # their body has been received.
+
+    MAX_HEADER_SIZE = 64 * 1024
+    MAX_BODY_SIZE = 16 * 1024 * 1024
+
+    class ParseError(Exception):
+
+        def __init__(self, code, message):
+            super().__init__(message)
+            self.code = code
+
+
+    def __init__(self):
+
+        self.buffer = bytearray()
+        self.scan_pos = 0
+        self.state = 'headers'
+        self.request = None
+        self.body_remaining = 0
+        self.body = bytearray()
+
+
+    def feed(self, data):
+
+        self.buffer += data
+        requests = []
+
+        while True:
+            if self.state == 'headers':
+                if not self.parse_headers():
+                    break
+            elif self.state == 'body':
+                take = min(self.body_remaining, len(self.buffer))
+                self.body += self.buffer[:take]
+                del self.buffer[:take]
+                self.body_remaining -= take
+                if self.body_remaining > 0:
+                    break
+                self.state = 'done'
+            elif self.state == 'chunk_size':
+                line = self.read_line()
+                if line is None:
+                    break
+                try:
+                    self.body_remaining = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise self.ParseError(400, 'Invalid chunk size')
+                if len(self.body) + self.body_remaining > self.MAX_BODY_SIZE:
+                    raise self.ParseError(413, 'Request body too large')
+                self.state = 'chunk_data' if self.body_remaining > 0 else 'chunk_trailer'
+            elif self.state == 'chunk_data':
+                # Chunk data is followed by a CRLF
+                if len(self.buffer) < self.body_remaining + 2:
+                    break
+                if self.buffer[self.body_remaining:self.body_remaining + 2] != b'\r\n':
+                    raise self.ParseError(400, 'Invalid chunk framing')
+                self.body += self.buffer[:self.body_remaining]
+                del self.buffer[:self.body_remaining + 2]
+                self.state = 'chunk_size'
+            elif self.state == 'chunk_trailer':
+                line = self.read_line()
+                if line is None:
+                    break
+                if line == b'':
+                    self.state = 'done'
+
+            if self.state == 'done':
+                self.request.body = bytes(self.body)
+                requests.append(self.request)
+                self.request = None
+                self.body = bytearray()
+                self.state = 'headers'
+
+        return requests
+
+
+    def read_line(self):
+
+        i = self.buffer.find(b'\r\n')
+        if i < 0:
+            if len(self.buffer) > self.MAX_HEADER_SIZE:
+                raise self.ParseError(400, 'Line too long')
+            return None
+        line = bytes(self.buffer[:i])
+        del self.buffer[:i + 2]
+        return line
+
+
+    def parse_headers(self):
+
+        # Only scan the newly arrived data for the end of the headers
+        header_end = self.buffer.find(b'\r\n\r\n', max(0, self.scan_pos - 3))
+        if header_end < 0:
+            self.scan_pos = len(self.buffer)
+            if len(self.buffer) > self.MAX_HEADER_SIZE:
+                raise self.ParseError(431, 'Request headers too large')
+            return False
+        if header_end > self.MAX_HEADER_SIZE:
+            raise self.ParseError(431, 'Request headers too large')
+
+        try:
+            lines = self.buffer[:header_end].decode('iso-8859-1').split('\r\n')
+        finally:
+            del self.buffer[:header_end + 4]
+            self.scan_pos = 0
+
+        # Skip empty lines in front of a request
+        while lines and lines[0] == '':
+            lines.pop(0)
+        request_line = lines[0].split() if lines else []
+        if len(request_line) != 3:
+            raise self.ParseError(400, 'Invalid request line')
+        method, uri, version = request_line
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise self.ParseError(400, 'Invalid header line')
+            name = name.strip().lower()
+            value = value.strip()
+            if name in headers:
+                headers[name] += ', ' + value
+            else:
+                headers[name] = value
+
+        self.request = HttpRequest(method, uri, version, headers)
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            self.state = 'chunk_size'
+        else:
+            try:
+                self.body_remaining = int(headers.get('content-length', '0'))
+            except ValueError:
+                raise self.ParseError(400, 'Invalid Content-Length')
+            if self.body_remaining < 0:
+                raise self.ParseError(400, 'Invalid Content-Length')
+            if self.body_remaining > self.MAX_BODY_SIZE:
+                raise self.ParseError(413, 'Request body too large')
+            self.state = 'body' if self.body_remaining > 0 else 'done'
+
+        return True
+
+
+
+def websocket_frame(payload, opcode=0x1):
+
+    # Unmasked final frame as sent by servers, opcode 0x1 is a text frame
+    header = bytearray([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header.append(length)
+    elif length < 0x10000:
+        header.append(126)
+        header += length.to_bytes(2, 'big')
+    else:
+        header.append(127)
+        header += length.to_bytes(8, 'big')
+    return bytes(header) + payload
+
+
+
+class WebSocketParser():
+
+    # Incremental parser for frames sent by WebSocket clients. Returns complete messages as (opcode, payload),
+    # fragmented messages are joined and control frames are returned as they arrive.
+
+    MAX_MESSAGE_SIZE = 1024 * 1024
+
+    class ParseError(Exception):
+        pass
+
+
+    def __init__(self, data=b''):
+
+        self.buffer = bytearray(data)
+        self.fragments = bytearray()
+        self.fragments_opcode = None
+
+
+    def feed(self, data):
+
+        self.buffer += data
+        messages = []
+
+        while len(self.buffer) >= 2:
+            b0, b1 = self.buffer[0], self.buffer[1]
+            fin = b0 & 0x80
+            opcode = b0 & 0x0F
+            if not b1 & 0x80:
+                raise self.ParseError('Client frames must be masked')
+
+            length = b1 & 0x7F
+            pos = 2
+            if length == 126:
+                if len(self.buffer) < 4:
+                    break
+                length = int.from_bytes(self.buffer[2:4], 'big')
+                pos = 4
+            elif length == 127:
+                if len(self.buffer) < 10:
+                    break
+                length = int.from_bytes(self.buffer[2:10], 'big')
+                pos = 10
+
+            if length + len(self.fragments) > self.MAX_MESSAGE_SIZE:
+                raise self.ParseError('Message too large')
+            if len(self.buffer) < pos + 4 + length:
+                break
+
+            mask = bytes(self.buffer[pos:pos + 4])
+            payload = bytes(self.buffer[pos + 4:pos + 4 + length])
+            del self.buffer[:pos + 4 + length]
+
+            # Unmask the whole payload at once
+            if length > 0:
+                mask_full = (mask * (length // 4 + 1))[:length]
+                payload = (int.from_bytes(payload, 'big') ^ int.from_bytes(mask_full, 'big')).to_bytes(length, 'big')
+
+            if opcode >= 0x8:
+                messages.append((opcode, payload))
+            elif opcode == 0x0:
+                if self.fragments_opcode is None:
+                    raise self.ParseError('Unexpected continuation frame')
+                self.fragments += payload
+                if fin:
+                    messages.append((self.fragments_opcode, bytes(self.fragments)))
+                    self.fragments = bytearray()
+                    self.fragments_opcode = None
+            elif fin:
+                messages.append((opcode, payload))
+            else:
+                self.fragments_opcode = opcode
+                self.fragments = bytearray(payload)
+
+        return messages
+
+
+
+class HttpConnection(asyncio.Protocol):
+
+    # Handlers receive the connection object in place of a raw socket. send/sendall/close may be called from any
+    # thread, the actual writes always happen on the server loop.
+
+    # Maximum number of pipelined requests buffered before reading from the socket is paused
+    MAX_PENDING_REQUESTS = 16
+
+    def __init__(self, server):
+
+        self.server = server
+        self.transport = None
+        self.parser = HttpRequestParser()
+        self.pending_requests = collections.deque()
+        self.request = None
+        # Set once the handler of the current request sent anything
+        self.responded = False
+        self.continued_request = None
+        # Set once the connection was upgraded to a WebSocket
+        self.websocket = None
+        self.message_handler = None
+        self.reading_paused = False
+        self.closing = False
+        self.pumping = False
+        self.writing_paused = False
+
+        # Streaming state, see hold()
+        self.producer = None
+        self.close_callbacks = []
+
+
+    def connection_made(self, transport):
+
+        self.transport = transport
+
+
+    def connection_lost(self, exc):
+
+        self.server.streams.discard(self)
+        self.producer = None
+        for callback in self.close_callbacks:
+            callback()
+        self.close_callbacks = []
+
+
+    def pause_writing(self):
+
+        self.writing_paused = True
+
+
+    def resume_writing(self):
+
+        self.writing_paused = False
+        self.pump()
+
+
+    def data_received(self, data):
+
+        if self.websocket is not None:
+            self.websocket_received(data)
+            return
+
+        # Held connections only send
+        if self.closing or self in self.server.streams:
+            return
+
+        try:
+            requests = self.parser.feed(data)
+        except HttpRequestParser.ParseError as e:
+            print('HTTP: Bad request:', e)
+            self.write(HttpResponse(e.code, headers={'Connection': 'close'}).header_text().encode())
+            self.close_now()
+            return
+
+        # Request body is still missing, tell clients waiting for it to go ahead
+        body_request = self.parser.request
+        if body_request is not None and body_request is not self.continued_request and \
+                body_request.header('Expect', '').lower() == '100-continue':
+            self.continued_request = body_request
+            self.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        self.pending_requests.extend(requests)
+        if len(self.pending_requests) >= self.MAX_PENDING_REQUESTS and not self.reading_paused:
+            self.transport.pause_reading()
+            self.reading_paused = True
+
+        self.next_request()
+
+
+    def next_request(self):
+
+        if self.request is not None or self.closing or not self.pending_requests:
+            return
+
+        self.request = self.pending_requests.popleft()
+        self.responded = False
+        if self.reading_paused and len(self.pending_requests) < self.MAX_PENDING_REQUESTS:
+            self.transport.resume_reading()
+            self.reading_paused = False
+
+        self.server.dispatch(self, self.request)
+
+
+    def start_websocket(self, message_handler):
+
+        # Anything the client sent after the upgrade request already belongs to the WebSocket
+        self.websocket = WebSocketParser(self.parser.buffer)
+        self.message_handler = message_handler
+        self.parser = None
+        self.pending_requests.clear()
+        self.server.streams.add(self)
+        if self.websocket.buffer:
+            self.websocket_received(b'')
+
+
+    def websocket_received(self, data):
+
+        if self.closing:
+            return
+
+        try:
+            messages = self.websocket.feed(data)
+        except WebSocketParser.ParseError as e:
+            print('HTTP: Bad WebSocket frame:', e)
+            self.write(websocket_frame((1002).to_bytes(2, 'big'), 0x8))
+            self.close_now()
+            return
+
+        for opcode, payload in messages:
+            if opcode == 0x1:
+                try:
+                    self.message_handler(self, payload.decode('utf-8'))
+                except Exception as e:
+                    print('HTTP: WebSocket handler failed:', repr(e))
+            elif opcode == 0x8:
+                # Echo the close frame and end the connection
+                self.write(websocket_frame(payload[:2], 0x8))
+                self.close_now()
+                return
+            elif opcode == 0x9:
+                self.write(websocket_frame(payload, 0xA))
+
+
+    def send_message(self, text):
+
+        # Sends a WebSocket text message, can be called from any thread
+        self.send(websocket_frame(text.encode('utf-8')))
+
+
+    def hold(self, producer=None, on_close=None):
+
+        # Keep the connection open after the handler returns. The producer is called on the server loop whenever
+        # the connection can take more data and returns the bytes to write (empty if there is nothing to send).
+        self.producer = producer
+        if on_close is not None:
+            self.close_callbacks.append(on_close)
+        self.server.streams.add(self)
+
+
+    def send(self, data):
+
+        self.responded = True
+        self.server.call_in_loop(self.write, data)
+        return len(data)
+
+
+    def sendall(self, data):
+
+        self.send(data)
+
+
+    def close(self):
+
+        self.server.call_in_loop(self.close_now)
+
+
+    # Only called on the server loop
+
+    def write(self, data):
+
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+
+    def close_now(self):
+
+        self.closing = True
+        self.server.streams.discard(self)
+        # When called from within the producer the returned data is still written, pump() closes afterwards
+        if self.transport is not None and not self.pumping:
+            # Pending writes are flushed before the socket is closed
+            self.transport.close()
+
+
+    def pump(self):
+
+        self.pumping = True
+        try:
+            while self.producer is not None and not self.writing_paused and not self.closing:
+                data = self.producer()
+                if data:
+                    self.write(data)
+                if not data or self.closing:
+                    break
+        finally:
+            self.pumping = False
+
+        if self.closing:
+            self.producer = None
+            self.close_now()
+
+
+    def handler_done(self):
+
+        if self in self.server.streams:
+            self.pump()
+            return
+
+        # Without a response the client would wait for it forever
+        if not self.responded:
+            self.send(HttpResponse(204).header_text().encode())
+
+        if self.request.keep_alive():
+            self.request = None
+            self.next_request()
+        else:
+            self.close_now()
+
+
+
 class HttpServer():
 
-    def __init__(self, host, port):
+    WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC11501'
+
+    def __init__(self, host, port, max_workers=4):
 
         self.host = host
         if hasattr(port, '__iter__'):
@@ -98,17 +756,21 @@ class HttpServer():
         self.port = None
 
         self.server_socket = None
-        self.is_closing = False
+
+        self.loop = None
+        self.loop_thread = None
+        self.loop_server = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='HttpServer')
+        self.streams = set()
 
         self.get_file_servers = {}
         self.get_handlers = {}
         self.post_handlers = {}
+        self.websocket_handlers = {}
 
 
-    def open(self):
-
-        if self.server_socket is not None:
-            return
+    def bind(self):
 
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -125,107 +787,219 @@ class HttpServer():
         else:
             raise OSError(errno.EADDRINUSE, 'No free port found.')
 
-        self.server_socket.listen(5)
+        self.server_socket.listen(64)
+        self.server_socket.setblocking(False)
+
+
+    def preload_files(self):
+
+        # Load and compress static files in the background so the first page load is cheap too
+        for static_file in self.get_file_servers.values():
+            self.executor.submit(static_file.get)
+
+
+    # The server either runs on a loop thread of its own (open/close) or on an already running loop (start/stop)
+
+    def open(self):
+
+        if self.server_socket is not None:
+            return
+
+        self.bind()
+        self.loop = asyncio.new_event_loop()
+        self.loop_server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: HttpConnection(self), sock=self.server_socket))
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='HttpServer')
+        self.loop_thread.start()
+        self.preload_files()
 
-        self.is_closing = False
-        self.listener_thread = threading.Thread(target=self.client_listener)
-        self.listener_thread.start()        
-        
 
     def close(self):
 
         if self.server_socket is None:
             return
 
-        self.is_closing = True
-        try:
-            self.server_socket.shutdown(socket.SHUT_RDWR)
-        except OSError:
-            pass
-        self.server_socket.close()
-        self.listener_thread.join()
+        def shutdown_and_stop():
+            self.shutdown()
+            # Give the transports one loop iteration to flush and close
+            self.loop.call_soon(self.loop.stop)
+
+        self.loop.call_soon_threadsafe(shutdown_and_stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+
+    async def start(self):
+
+        if self.server_socket is not None:
+            return
+
+        self.bind()
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.loop_server = await self.loop.create_server(lambda: HttpConnection(self), sock=self.server_socket)
+        self.preload_files()
+
+
+    async def stop(self):
+
+        if self.server_socket is None:
+            return
+
+        self.shutdown()
+        # Give the transports one loop iteration to flush and close
+        await asyncio.sleep(0)
+
+
+    def shutdown(self):
+
+        # Teardown shared by close() and stop(), runs on the server loop
+        self.loop_server.close()
+        for connection in list(self.streams):
+            connection.close_now()
+        self.executor.shutdown(wait=False)
         self.server_socket = None
 
 
+    def call_in_loop(self, func, *args):
+
+        if self.loop is None or self.loop.is_closed():
+            return
+        if threading.current_thread() is self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+
+    def notify_streams(self):
+
+        # Asks all held connections to pull from their producers, can be called from any thread
+        def pump_all():
+            for connection in list(self.streams):
+                connection.pump()
+
+        self.call_in_loop(pump_all)
+
+
     def set_get_file_server(self, uri, serve_path):
 
-        self.get_file_servers[uri] = serve_path
+        self.get_file_servers[uri] = HttpStaticFile(serve_path)
 
 
-    def set_get_handler(self, uri, handler):
+    # Handlers run on the server loop and must not block. Pass blocking=True for handlers that do slow work, those
+    # are run on the worker pool instead.
 
-        self.get_handlers[uri] = handler
+    def set_get_handler(self, uri, handler, blocking=False):
+
+        self.get_handlers[uri] = (handler, blocking)
 
     
-    def set_post_handler(self, uri, handler):
+    def set_post_handler(self, uri, handler, blocking=False):
 
-        self.post_handlers[uri] = handler
+        self.post_handlers[uri] = (handler, blocking)
 
 
-    def client_listener(self):
+    # The open handler is called with the connection once the upgrade is done, like a get handler it can hold() the
+    # connection with a producer that returns WebSocket frames. The message handler is called for every text message
+    # the client sends. Both run on the server loop.
 
-        while not self.is_closing:
-            try:
-                client_socket, client_address = self.server_socket.accept()
-            except:
-                continue
+    def set_websocket_handler(self, uri, open_handler, message_handler):
+
+        self.websocket_handlers[uri] = (open_handler, message_handler)
+
+
+    def dispatch(self, connection, request):
+
+        if request.method == 'GET' and request.header('Upgrade', '').lower() == 'websocket':
+            handlers = self.websocket_handlers.get(request.path)
+            if handlers:
+                self.upgrade_websocket(connection, request, *handlers)
+                return
+
+        if request.method == 'GET':
+            static_file = self.get_file_servers.get(request.path)
+            if static_file:
+                # Only go through the worker pool if the file has to be (re)loaded from disk
+                self.run_handler(connection, self.serve_file, (static_file,), not static_file.is_fresh())
+                return
+            handler = self.get_handlers.get(request.path)
+            args = ()
+        elif request.method == 'POST':
+            handler = self.post_handlers.get(request.path)
+            args = (request.body,)
+        else:
+            handler = None
+
+        if handler is None:
+            connection.send(HttpResponse(404).header_text().encode())
+            self.handler_finished(connection, None)
+            return
+
+        handler_func, blocking = handler
+        self.run_handler(connection, handler_func, args, blocking)
+
+
+    def upgrade_websocket(self, connection, request, open_handler, message_handler):
 
-            handler_thread = threading.Thread(target=self.client_handler, args=(client_socket, client_address))
-            handler_thread.start()
+        key = request.header('Sec-WebSocket-Key')
+        if not key or request.header('Sec-WebSocket-Version') != '13':
+            r = HttpResponse(400, headers={'Sec-WebSocket-Version': '13', 'Connection': 'close'})
+            connection.write(r.header_text().encode())
+            connection.close_now()
+            return
+
+        # Other websites must not be able to talk to us through the browser
+        origin = request.header('Origin')
+        if origin and urllib.parse.urlparse(origin).netloc != request.header('Host'):
+            print('HTTP: Rejected WebSocket from origin', origin)
+            connection.write(HttpResponse(403, headers={'Connection': 'close'}).header_text().encode())
+            connection.close_now()
+            return
+
+        accept = base64.b64encode(hashlib.sha1((key + self.WEBSOCKET_GUID).encode()).digest()).decode()
+        r = HttpResponse(101, headers={
+            'Upgrade': 'websocket',
+            'Connection': 'Upgrade',
+            'Sec-WebSocket-Accept': accept,
+        }, stream=True)
+        connection.write(r.header_text().encode())
+        connection.start_websocket(message_handler)
+
+        self.run_handler(connection, open_handler, (), False)
 
 
-    def client_handler(self, socket, address):
+    def run_handler(self, connection, handler, args, blocking):
+
+        if blocking:
+            future = self.loop.run_in_executor(self.executor, handler, connection, *args)
+            future.add_done_callback(lambda f: self.handler_finished(connection, f.exception()))
+            return
 
         try:
-            recv_data = socket.recv(1024)
-            header_line_end = recv_data.find(b'\r')
-            header_line_segs = recv_data[:header_line_end].decode().split()
-            method = header_line_segs[0]
-            uri = header_line_segs[1]
-        except:
-            socket.close()
-            return
-
-        if method == 'GET':
-            serve_path = self.get_file_servers.get(uri)
-            if serve_path:
-                f = open(serve_path, 'rb')
-                serve_content = f.read()
-                f.close()
-                r = HttpResponse(content=serve_content, content_type='text/html')
-                r.send(socket)                
-            else:
-                handler = self.get_handlers.get(uri)
-                if handler:
-                    handler(socket)
-
-        elif method == 'POST':
-            handler = self.post_handlers.get(uri)
-            if handler:
-                contents = None
-
-                header_end = recv_data.find(b'\r\n\r\n')
-
-                if header_end >= 0:
-                    i = recv_data.find(b'Content-Length:')
-                    if i >= 0 and i < header_end:
-                        j = recv_data.find(b'\r\n', i)
-                        try:
-                            contents_length = int(recv_data[i+15:j].decode().strip())
-
-                            if contents_length >= 0:
-                                contents = recv_data[header_end+4:]
-
-                            remaining_read_len = contents_length - len(contents)
-
-                            while remaining_read_len > 0:
-                                now_read_try_len = min(1024, remaining_read_len)
-                                now_read = socket.recv(now_read_try_len)
-                                contents += now_read
-                                remaining_read_len -= len(now_read)
-                        except:
-                            pass
-                            
-                handler(socket, contents)
-
-        socket.close()
+            handler(connection, *args)
+        except Exception as e:
+            self.handler_finished(connection, e)
+        else:
+            self.handler_finished(connection, None)
+
+
+    def handler_finished(self, connection, exc):
+
+        if exc is not None:
+            print('HTTP: Handler failed:', repr(exc))
+            # A response that was started already can only be cut off
+            if not connection.responded:
+                connection.send(HttpResponse(500, headers={'Connection': 'close'}).header_text().encode())
+            connection.close_now()
+            return
+        connection.handler_done()
+
+
+    def serve_file(self, connection, static_file):
+
+        content = static_file.get()
+        if content is None:
+            r = HttpResponse(404)
+        else:
+            r = content.response(connection.request)
+        r.send(connection)
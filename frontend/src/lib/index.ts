@@ -1,22 +1,124 @@
 export interface Subtitle {
+  id: number;
   start: number;
   end: number;
   text: string;
 }
 
+// Subtitles with the version of the backend state their ids belong to
+export interface SubtitleList {
+  version: number;
+  subtitles: Subtitle[];
+}
+
+// Wire format of /subs and /secondary_subs
+interface SubtitleColumns {
+  version: number;
+  start: number[];
+  end: number[];
+  text: string[];
+}
+
+// Result of /search, current tracks have the id of the cue, cached ones the file they came from
+export interface SearchResult {
+  track: 'primary' | 'secondary' | 'cache';
+  id?: number;
+  source?: string;
+  start: number;
+  end: number;
+  text: string;
+}
+
+export interface MpvReply {
+  error: string;
+  data: any;
+}
+
 export const SUB_MODES = ['Default', 'Reading', 'Recall', 'Hidden'];
 
-export async function mpvControl(command: string, args: any[]) {
+// Control socket carrying both backend events and mpv commands, see connectControl()
+let controlSocket: WebSocket | null = null;
+let nextRequestId = 1;
+const pendingRequests = new Map<number, (reply: MpvReply) => void>();
+
+export async function mpvControl(command: string, args: any[]): Promise<MpvReply | null> {
+  const commandArgs = [command].concat(args);
+
+  if (controlSocket?.readyState === WebSocket.OPEN) {
+    const id = nextRequestId++;
+    const reply = new Promise<MpvReply>((resolve) => pendingRequests.set(id, resolve));
+    controlSocket.send(JSON.stringify({'id': id, 'command': commandArgs}));
+    return reply;
+  }
+
+  // Fall back to a plain request while the socket is not connected
   await fetch('./mpv_control', {
     method: 'POST',
     headers: {
       'Content-Type': 'text/plain;charset=UTF-8',
     },
-    body: JSON.stringify({'command': [command].concat(args)}),
+    body: JSON.stringify({'command': commandArgs}),
   });
+  return null;
+}
+
+// Connects the control socket and reconnects when it drops, resuming from the last received event.
+// Returns a function that closes the socket for good.
+export function connectControl(onEvent: (msg: string) => void,
+                               onConnectedChange: (connected: boolean) => void): () => void {
+  let lastEventId: string | null = null;
+  let closed = false;
+
+  function connect() {
+    let url = `ws://${location.host}/control`;
+    if (lastEventId !== null) {
+      url += '?last_event_id=' + encodeURIComponent(lastEventId);
+    }
+
+    const socket = new WebSocket(url);
+    controlSocket = socket;
+
+    socket.onopen = () => onConnectedChange(true);
+
+    socket.onmessage = (e) => {
+      const msg = JSON.parse(e.data);
+      if ('reply' in msg) {
+        pendingRequests.get(msg.reply)?.(msg);
+        pendingRequests.delete(msg.reply);
+        return;
+      }
+      if (msg.id !== null) {
+        lastEventId = msg.id;
+      }
+      // Sent on connect, only carries the id to resume from
+      if (msg.data === null) {
+        return;
+      }
+      if (msg.data === 'q') {
+        closed = true;
+      }
+      onEvent(msg.data);
+    };
+
+    socket.onclose = () => {
+      controlSocket = null;
+      pendingRequests.clear();
+      onConnectedChange(false);
+      if (!closed) {
+        setTimeout(connect, 1000);
+      }
+    };
+  }
+
+  connect();
+
+  return () => {
+    closed = true;
+    controlSocket?.close();
+  };
 }
 
-export async function fetchStubs(url: string): Promise<Subtitle[]> {
+export async function fetchStubs(url: string): Promise<SubtitleList | null> {
   function cleanSubText(sub: Subtitle): Subtitle {
     // Remove \n from subtitles text and trim them
     sub.text = sub.text.replace(/\n/g, ' ').trim();
@@ -35,9 +137,35 @@ export async function fetchStubs(url: string): Promise<Subtitle[]> {
   const response = await fetch(url);
   if (!response.ok) {
     console.error(`Failed to fetch subtitles from ${url}: ${response.statusText}`);
+    return null;
+  }
+
+  // Subtitles are sent as columns, ids are the indices
+  const columns: SubtitleColumns = await response.json();
+  const subs: Subtitle[] = columns.start.map((start, i) => ({
+    id: i,
+    start: start,
+    end: columns.end[i],
+    text: columns.text[i],
+  }));
+
+  return {
+    version: columns.version,
+    subtitles: subs.map(cleanSubText)
+      // Filter out empty subtitles
+      .filter((sub: Subtitle) => sub.text.trim().length > 0),
+  };
+}
+export async function searchSubtitles(query: string, includeCache: boolean): Promise<SearchResult[]> {
+  let url = './search?q=' + encodeURIComponent(query);
+  if (includeCache) {
+    url += '&cache=1';
+  }
+
+  const response = await fetch(url);
+  if (!response.ok) {
+    console.error(`Failed to search subtitles: ${response.statusText}`);
     return [];
   }
-  return (await response.json()).map(cleanSubText)
-    // Filter out empty subtitles
-    .filter((sub: Subtitle) => sub.text.trim().length > 0);
-}
\ No newline at end of file
+  return (await response.json()).results;
+}
@@ -372,6 +372,10 @@ local function on_migaku_resync()
     resync_menu:open()
 end
 
+local function on_migaku_resync_cancel()
+    mp.commandv('script-message', '@migaku', 'resync-cancel')
+end
+
 local function on_mouse_move(_, value)
     local secondary_subs_enabled = value['hover']
 
@@ -434,7 +438,32 @@ local function find_track_sid_for_langs(lang_list_string, type)
     return nil
 end
 
+local function get_internal_subtitle_tracks()
+    local tracks = {}
+    local tracks_count = mp.get_property_number('track-list/count')
+
+    for i = 0, (tracks_count - 1) do
+        local track_type = mp.get_property(string.format('track-list/%d/type', i))
+        local track_codec = mp.get_property(string.format('track-list/%d/codec', i))
+        local track_ext_path = mp.get_property(string.format('track-list/%d/external-filename', i))
+
+        if track_type == 'sub' and track_ext_path == nil and is_sub_codec_supported(track_codec) then
+            local track_ff_index = mp.get_property(string.format('track-list/%d/ff-index', i))
+            table.insert(tracks, string.format('%s*%s', track_ff_index, track_codec))
+        end
+    end
+
+    return tracks
+end
+
 local function on_file_loaded()
+    -- Let the backend export internal subtitle tracks and prefetch the next playlist entries in the background
+    local file_name = mp.get_property('path')
+    local internal_tracks = get_internal_subtitle_tracks()
+    if file_name ~= nil then
+        mp.commandv('script-message', '@migaku', 'file-loaded', file_name, (table.unpack or unpack)(internal_tracks))
+    end
+
     local secondary_sid = find_track_sid_for_langs(config['secondary_sub_lang'], 'sub')
     if secondary_sid ~= nil then
         mp.set_property('secondary-sid', secondary_sid)
@@ -461,6 +490,7 @@ mp.register_event('file-loaded', on_file_loaded)
 mp.register_script_message('@migakulua', on_script_message)
 mp.add_key_binding('b', 'migaku-open', on_migaku_open)
 mp.add_key_binding('B', 'migaku-resync', on_migaku_resync)
+mp.add_key_binding('Ctrl+B', 'migaku-resync-cancel', on_migaku_resync_cancel)
 
 on_initialize()
 